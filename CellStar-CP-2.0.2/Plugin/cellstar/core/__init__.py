@@ -4,4 +4,4 @@ Core package including main components used in CellStar segmentation.
 Date: 2013-2016
 Website: http://cellstar-algorithm.org/
 """
-__all__ = ["image_repo", "point", "seed", "seeder", "snake", "snake_filter"]
+__all__ = ["batch_grow", "image_repo", "point", "seed", "seeder", "snake", "snake_filter", "tiling"]
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Batch grow calculates contour quality for many seeds at once and grows snakes from it.
+Date: 2013-2016
+Website: http://cellstar-algorithm.org/
+"""
+
+import math
+from copy import copy
+
+import numpy as np
+
+from cellstar.utils import calc_util
+from cellstar.utils.index import Index
+
+
+class BatchGrower(object):
+    """
+    Grows a number of snakes at once. Contour quality for all the seeds is calculated as a single
+    (seeds x angles x radii) cube using vectorized operations, seeds are processed in chunks so that
+    the memory used by the cube and its temporaries does not exceed the configured limit.
+
+    @type polar_transform: cellstar.core.polar_transform.PolarTransform
+    @ivar chunk_size: number of seeds processed at once
+    """
+
+    epsilon = 1e-10
+    # number of (radii x angles) arrays allocated per seed during quality calculation and smoothing
+    arrays_per_seed = 14
+
+    def __init__(self, images, parameters, polar_transform):
+        """
+        @type images: cellstar.core.image_repo.ImageRepo
+        @type parameters: dict
+        @type polar_transform: cellstar.core.polar_transform.PolarTransform
+        """
+        self.images = images
+        self.parameters = parameters
+        self.polar_transform = polar_transform
+
+        stars = parameters["segmentation"]["stars"]
+        avg_cell_diameter = parameters["segmentation"]["avgCellDiameter"]
+        self.step = polar_transform.step
+        self.avg_cell_diameter = avg_cell_diameter
+        self.gradient_weight = stars["gradientWeight"]
+        self.brightness_weight = stars["brightnessWeight"]
+        self.cum_brightness_weight = stars["cumBrightnessWeight"] / avg_cell_diameter
+        self.background_weight = stars["backgroundWeight"] / avg_cell_diameter
+        self.border_thickness_steps = 1 + math.floor(float(stars["borderThickness"]) / float(self.step))
+        self.max_diff = (abs(stars["smoothness"]) * np.arange(1, polar_transform.steps + 1)
+                         / polar_transform.N + 0.5).astype(int)
+        self.log_r = np.log(polar_transform.R.flat)
+
+        seed_bytes = polar_transform.x.size * np.dtype(np.float64).itemsize * self.arrays_per_seed
+        chunk_bytes = parameters["segmentation"]["processing"]["growChunkMB"] * 2 ** 20
+        self.chunk_size = max(1, int(chunk_bytes // seed_bytes))
+
+    def chunks(self, snakes):
+        for start in range(0, len(snakes), self.chunk_size):
+            yield snakes[start:start + self.chunk_size]
+
+    def quality_terms(self, xs, ys):
+        """
+        Calculates the parts of contour quality which do not depend on size weight.
+        @param xs: x coordinates of seeds
+        @type xs: np.ndarray
+        @param ys: y coordinates of seeds
+        @type ys: np.ndarray
+        @return: cumulated interior quality, gradient and brightness terms as (seeds x radii x angles) cubes
+        @rtype: (np.ndarray, np.ndarray, np.ndarray)
+        """
+        polar_transform = self.polar_transform
+        im = self.images.image_back_difference_blurred
+        imb = self.images.brighter
+        imfg = self.images.foreground_mask
+
+        px = np.asarray(xs, dtype=float)[:, np.newaxis, np.newaxis] + polar_transform.x
+        px = np.maximum(px, 0)
+        px = np.minimum(px, im.shape[1] - 1)
+
+        py = np.asarray(ys, dtype=float)[:, np.newaxis, np.newaxis] + polar_transform.y
+        py = np.maximum(py, 0)
+        py = np.minimum(py, im.shape[0] - 1)
+
+        # index is ordered first by seed, then by radius, then by angle
+        index = Index.create(px.round(), py.round()).reshape(px.shape + (2,))
+        del px, py
+
+        numpy_index = Index.to_numpy(index)
+        pre_f = (self.cum_brightness_weight * imb[numpy_index]
+                 + self.background_weight * (1 - imfg[numpy_index])) * self.step
+        f = np.cumsum(pre_f, axis=1)
+        del pre_f
+
+        gradient_term = self.gradient_weight * calc_util.get_gradient(im, index, self.border_thickness_steps)
+        brightness_term = self.brightness_weight * im[numpy_index]
+
+        return f, gradient_term, brightness_term
+
+    def quality(self, terms, size_weight):
+        """
+        Calculates normalized contour quality for the given size weight.
+        @param terms: size weight independent quality terms (see quality_terms)
+        @type size_weight: float
+        @return: (seeds x angles x radii) quality cube (the smaller the better) and best radius for every ray
+        @rtype: (np.ndarray, np.ndarray)
+        """
+        f, gradient_term, brightness_term = terms
+
+        f_tot = f - float(size_weight) / self.avg_cell_diameter * self.log_r[:, np.newaxis]
+        f_tot -= gradient_term
+        f_tot -= brightness_term
+
+        f_tot = np.ascontiguousarray(f_tot.transpose((0, 2, 1)))
+
+        # Scale entire array to 0-1 then scale individual angles.
+        f_min = f_tot.min(axis=(1, 2))[:, np.newaxis, np.newaxis]
+        f_max = f_tot.max(axis=(1, 2))[:, np.newaxis, np.newaxis]
+        f_tot -= f_min
+        f_tot /= (f_max - f_min + self.epsilon)
+        f_tot /= f_tot.max(axis=2)[:, :, np.newaxis] + self.epsilon
+
+        best_radius = f_tot.argmin(axis=2)
+        return f_tot, best_radius
+
+    def smoothed_radius(self, terms, size_weight):
+        """
+        Calculates best radii for the given size weight and smooths them.
+        @param terms: size weight independent quality terms (see quality_terms)
+        @type size_weight: float
+        @return: best, smoothed and bounding radius for every ray as (seeds x angles) arrays
+        @rtype: (np.ndarray, np.ndarray, np.ndarray)
+        """
+        f_tot, best_radius = self.quality(terms, size_weight)
+        smoothed_radius, radius_bounds = calc_util.smooth_contours(best_radius, self.max_diff, f_tot)
+        return best_radius, smoothed_radius, radius_bounds
+
+    @staticmethod
+    def seeds_coordinates(snakes):
+        return np.array([s.seed.x for s in snakes], dtype=float), np.array([s.seed.y for s in snakes], dtype=float)
+
+    def grow(self, snakes, size_weight):
+        """
+        Grow all given snakes from their seeds, snakes are modified in place.
+        @type snakes: list[cellstar.core.snake.Snake]
+        @type size_weight: float
+        """
+        for chunk in self.chunks(snakes):
+            best_radius, smoothed_radius, radius_bounds = \
+                self.smoothed_radius(self.quality_terms(*self.seeds_coordinates(chunk)), size_weight)
+            for i, snake in enumerate(chunk):
+                snake.grow_from_smoothed_radius(best_radius[i], smoothed_radius[i], radius_bounds[i],
+                                                self.polar_transform)
+
+    def grow_size_weights(self, snakes, size_weights):
+        """
+        Grow a copy of every snake for every size weight. Size weight independent part of the quality
+        is calculated only once per seed.
+        @type snakes: list[cellstar.core.snake.Snake]
+        @type size_weights: list[float]
+        @return: for every snake the list of its copies grown with consecutive size weights
+        @rtype: list[list[cellstar.core.snake.Snake]]
+        """
+        grown_snakes = []
+        for chunk in self.chunks(snakes):
+            grown_chunk = [[] for _ in chunk]
+            terms = self.quality_terms(*self.seeds_coordinates(chunk))
+            for weight in size_weights:
+                best_radius, smoothed_radius, radius_bounds = self.smoothed_radius(terms, weight)
+                for i, snake in enumerate(chunk):
+                    grown_snake = copy(snake)
+                    grown_snake.grow_from_smoothed_radius(best_radius[i], smoothed_radius[i], radius_bounds[i],
+                                                          self.polar_transform)
+                    grown_chunk[i].append(grown_snake)
+            grown_snakes += grown_chunk
+
+        return grown_snakes
+
+    def grow_best(self, snakes, size_weights):
+        """
+        Grow every snake with all size weights, evaluate the results and keep the best ranked one.
+        If several size weights give the same rank the first one wins.
+        @type snakes: list[cellstar.core.snake.Snake]
+        @type size_weights: list[float]
+        @return: best grown snake for every given snake
+        @rtype: list[cellstar.core.snake.Snake]
+        """
+        best_snakes = []
+        for weighted_snakes in self.grow_size_weights(snakes, size_weights):
+            best_snake = None
+            for curr_snake in weighted_snakes:
+                curr_snake.evaluate(self.polar_transform)
+                if best_snake is None or curr_snake.rank < best_snake.rank:
+                    best_snake = curr_snake
+            best_snakes.append(best_snake)
+
+        return best_snakes
@@ -79,6 +79,19 @@ def default_config():
                 'randomDiskRadius': 0.33,
                 'minDistance': 0.27,
                 'BorderBlur': 2
+            },
+            'processing': {
+                'growChunkMB': 64,
+                'executor': 'serial',
+                'workers': 0,
+                'rasterizer': 'pil',
+                'background': 'exact',
+                'median': 'scipy',
+                'medianLevels': 64,
+                'precision': 'double',
+                'memoryBudgetMB': 0,
+                'blurCacheMB': 128,
+                'tileSize': 0
             }
         }
     }
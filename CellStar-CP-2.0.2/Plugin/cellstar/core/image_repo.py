@@ -6,9 +6,14 @@ Website: http://cellstar-algorithm.org/
 """
 
 import math
+import multiprocessing.pool
+import tempfile
 
 from cellstar.utils.image_util import *
 
+# Minimal radius of the first background blur in the downsampled image.
+PYRAMID_MIN_RADIUS = 4
+
 
 class ImageRepo(object):
     """
@@ -16,6 +21,30 @@ class ImageRepo(object):
     background mask, and others.
     """
 
+    # intermediate images (float images and masks)
+    intermediate_fields = ["_background", "_brighter_original", "_darker_original", "_clean_original", "_brighter",
+                           "_darker", "_clean", "_foreground_mask", "_background_mask", "_cell_border_mask",
+                           "_cell_content_mask"]
+    # intermediate images read after preprocessing by seeding, growing, evaluation and filtering of snakes
+    # (background is used by the next frame)
+    used_after_pre_process = ["_background", "_clean_original", "_brighter", "_darker", "_clean", "_foreground_mask",
+                              "_cell_content_mask"]
+    # directory of memory mapped files of images which do not fit in memory budget (None is system default)
+    spill_directory = None
+    # preprocessing steps: name of calculate_<name> method -> (calculated fields, steps whose results it reads)
+    pre_process_steps = {
+        "background": (["_background"], []),
+        "brighter_original": (["_brighter_original"], ["background"]),
+        "darker_original": (["_darker_original"], ["background"]),
+        "clean_original": (["_clean_original"], ["background"]),
+        "forebackground_masks": (["_foreground_mask", "_background_mask"], ["brighter_original", "darker_original"]),
+        "clean": (["_clean"], ["clean_original", "forebackground_masks"]),
+        "brighter": (["_brighter"], ["brighter_original", "forebackground_masks"]),
+        "darker": (["_darker"], ["darker_original", "forebackground_masks"]),
+        "cell_border_content_mask": (["_cell_border_mask", "_cell_content_mask"],
+                                     ["brighter", "darker", "forebackground_masks"]),
+    }
+
     @property
     def background(self):
         if self._background is None:
@@ -36,7 +65,7 @@ class ImageRepo(object):
 
     @property
     def brighter_original(self):
-        if self._brighter is None:
+        if self._brighter_original is None:
             self.calculate_brighter_original()
 
         return self._brighter_original
@@ -129,6 +158,8 @@ class ImageRepo(object):
         @type parameters: dict
         """
         self.parameters = parameters
+        # type of intermediate float images
+        self.float_type = np.float32 if parameters["segmentation"]["processing"]["precision"] == "single" else float
 
         # float arrays
         self.image = image
@@ -148,14 +179,156 @@ class ImageRepo(object):
         self._cell_border_mask = None
         self._cell_content_mask = None
 
-        # cache
-        self._blurred = []  # (image,blur,image_blurred)
+        # blurred images keyed by identity of the image, generation and blur
+        self._blurred = ArrayCache(parameters["segmentation"]["processing"]["blurCacheMB"] * 2 ** 20)
+        # increased when intermediate images are modified in place (see modified)
+        self.generation = 0
 
         # segmentation labels
         self._segmentation = None
 
+        # statistics of the whole frame used instead of the ones of this image if it is a tile of the frame
+        # (see cellstar.core.tiling.frame_statistics)
+        self.frame_statistics = None
+
+        # memory of intermediate images
+        self.peak_bytes = 0
+        self.spilled_bytes = 0
+
+    @property
+    def nbytes(self):
+        """
+        @return: memory used by intermediate images, blurred images cache and labels (without spilled images)
+        @rtype: int
+        """
+        arrays = [getattr(self, field) for field in self.intermediate_fields + ["_segmentation"]]
+        return self._blurred.nbytes + sum(a.nbytes for a in arrays if a is not None and not isinstance(a, np.memmap))
+
+    def memory_statistics(self):
+        """
+        @return: peak and current memory of intermediate images and memory of spilled images
+        @rtype: dict
+        """
+        self.peak_bytes = max(self.peak_bytes, self.nbytes)
+        return {"peak_bytes": self.peak_bytes, "retained_bytes": self.nbytes, "spilled_bytes": self.spilled_bytes}
+
+    def release_intermediates(self):
+        """
+        Frees intermediate images which are not read after preprocessing (they are calculated again if needed).
+        If the remaining ones use more than processing memoryBudgetMB, the largest of them are moved to memory
+        mapped temporary files until they fit.
+        """
+        self.peak_bytes = max(self.peak_bytes, self.nbytes)
+        for field in self.intermediate_fields:
+            if field not in self.used_after_pre_process:
+                setattr(self, field, None)
+
+        # blurred images used in preprocessing are not needed any more
+        self._blurred.clear()
+
+        budget = self.memory_budget()
+        if budget is None:
+            return
+
+        in_memory = [field for field in self.used_after_pre_process
+                     if getattr(self, field) is not None and not isinstance(getattr(self, field), np.memmap)]
+        for field in sorted(in_memory, key=lambda f: getattr(self, f).nbytes, reverse=True):
+            if self.nbytes <= budget:
+                break
+            self.spill(field)
+
+        self.fit_blur_cache()
+
+    def pre_process_levels(self, fields=None):
+        """
+        Plans calculation of intermediate images and of the ones they depend on. Steps whose images are already
+        calculated (e.g. background of the previous frame) are skipped together with their dependencies.
+        @param fields: needed intermediate images, by default the ones read after preprocessing
+        @return: lists of steps to calculate one after another, steps in one list are independent
+        @rtype: list[list[str]]
+        """
+        if fields is None:
+            fields = self.used_after_pre_process
+
+        def calculated(step):
+            return all(getattr(self, field) is not None for field in self.pre_process_steps[step][0])
+
+        needed = set()
+        to_visit = [step for step, (step_fields, _) in self.pre_process_steps.items()
+                    if set(step_fields) & set(fields)]
+        while to_visit:
+            step = to_visit.pop()
+            if step not in needed and not calculated(step):
+                needed.add(step)
+                to_visit += self.pre_process_steps[step][1]
+
+        levels = []
+        done = set(self.pre_process_steps) - needed
+        while needed:
+            level = sorted(step for step in needed if done.issuperset(self.pre_process_steps[step][1]))
+            levels.append(level)
+            needed.difference_update(level)
+            done.update(level)
+        return levels
+
+    def pre_process(self, workers=1, fields=None):
+        """
+        Calculates intermediate images which are not calculated yet, independent steps run concurrently in a pool
+        of threads (SciPy filters and FFT release GIL).
+        @param workers: number of threads, if 1 steps are calculated in the calling thread
+        @param fields: needed intermediate images, by default the ones read after preprocessing
+        """
+        levels = self.pre_process_levels(fields)
+        threads = min(workers, max([len(level) for level in levels] + [1]))
+        if threads <= 1:
+            for level in levels:
+                for step in level:
+                    getattr(self, "calculate_" + step)()
+            return
+
+        pool = multiprocessing.pool.ThreadPool(processes=threads)
+        try:
+            for level in levels:
+                pool.map(lambda step: getattr(self, "calculate_" + step)(), level)
+        finally:
+            pool.close()
+            pool.join()
+
+    def memory_budget(self):
+        """
+        @return: memory budget of intermediate images in bytes or None if there is no budget
+        """
+        budget = self.parameters["segmentation"]["processing"]["memoryBudgetMB"] * 2 ** 20
+        return budget if budget > 0 else None
+
+    def spill(self, field):
+        """
+        Moves intermediate image to memory mapped temporary file.
+        """
+        image = getattr(self, field)
+        with tempfile.TemporaryFile(dir=self.spill_directory) as spill_file:
+            spilled = np.memmap(spill_file, dtype=image.dtype, mode="w+", shape=image.shape)
+        spilled[...] = image
+        setattr(self, field, spilled)
+        self.spilled_bytes += spilled.nbytes
+
     def init_segmentation(self):
-        self._segmentation = np.zeros(self.image.shape[:2], int)
+        self._segmentation = np.zeros(self.image.shape[:2], self.label_type(0))
+
+    def label_type(self, labels_number):
+        """
+        @return: type of label images with given maximal label, the smallest sufficient unsigned type in single
+        precision mode
+        """
+        if self.float_type == float:
+            return int
+        return np.min_scalar_type(labels_number)
+
+    def store(self, image):
+        """
+        @return: intermediate float image converted to float_type
+        """
+        return image.astype(self.float_type, copy=False)
 
     def calculate_background(self, background_mask=None):
         """
@@ -165,23 +338,7 @@ class ImageRepo(object):
 
         # No background mask is provided so calculate one based on edges in the image.
         if background_mask is None:
-            smoothed = image_smooth(self.image, int(self.parameters["segmentation"]["background"]["computeByBlurring"]
-                                                    * self.parameters["segmentation"]["avgCellDiameter"]))
-            foreground_mask = image_normalize(abs(self.image - smoothed)) \
-                              > self.parameters["segmentation"]["foreground"]["MaskThreshold"]
-
-            foreground_mask = \
-                fill_foreground_holes(foreground_mask,
-                                      self.parameters["segmentation"]["foreground"]["MaskDilation"]
-                                      * self.parameters["segmentation"]["avgCellDiameter"],
-                                      self.parameters["segmentation"]["foreground"]["FillHolesWithAreaSmallerThan"]
-                                      * self.parameters["segmentation"]["avgCellDiameter"] ** 2 * math.pi / 4,
-                                      self.parameters["segmentation"]["foreground"]["MinCellClusterArea"]
-                                      * self.parameters["segmentation"]["avgCellDiameter"] ** 2 * math.pi / 4,
-                                      self.parameters["segmentation"]["foreground"]["MaskMinRadius"]
-                                      * self.parameters["segmentation"]["avgCellDiameter"]
-                                      )
-            background_mask = np.logical_not(foreground_mask)
+            background_mask = self.calculate_background_mask()
 
         if self._mask is not None:
             background_mask |= np.logical_not(self._mask)
@@ -196,27 +353,155 @@ class ImageRepo(object):
         background = background * background_mask + filler_value * foreground_mask
 
         # Spread foreground to background pixels
+        radiuses = self.background_smooth_radiuses()
+        first_step = 0
+        if self.parameters["segmentation"]["processing"]["background"] == "pyramid":
+            background, first_step = self.spread_background_downsampled(background, background_mask, radiuses)
+
+        background = self.spread_background(background, background_mask, radiuses[first_step:], first_step == 0)
+        self._background = self.store(background)
+
+    def background_difference(self):
+        """
+        @return: absolute difference of the image and the image smoothed with background computeByBlurring
+        """
+        smoothed = image_smooth(self.image, int(self.parameters["segmentation"]["background"]["computeByBlurring"]
+                                                * self.parameters["segmentation"]["avgCellDiameter"]),
+                                keep_spectrum=True)
+        return abs(self.image - smoothed)
+
+    def calculate_background_mask(self, difference_range=(None, None)):
+        """
+        Determines background as the part of the image which does not differ much from its smoothed version.
+        @param difference_range: range of background_difference used in its normalization, range of this image
+        if not given
+        @return: background mask
+        """
+        foreground_mask = image_normalize(self.background_difference(), *difference_range) \
+                          > self.parameters["segmentation"]["foreground"]["MaskThreshold"]
+
+        foreground_mask = \
+            fill_foreground_holes(foreground_mask,
+                                  self.parameters["segmentation"]["foreground"]["MaskDilation"]
+                                  * self.parameters["segmentation"]["avgCellDiameter"],
+                                  self.parameters["segmentation"]["foreground"]["FillHolesWithAreaSmallerThan"]
+                                  * self.parameters["segmentation"]["avgCellDiameter"] ** 2 * math.pi / 4,
+                                  self.parameters["segmentation"]["foreground"]["MinCellClusterArea"]
+                                  * self.parameters["segmentation"]["avgCellDiameter"] ** 2 * math.pi / 4,
+                                  self.parameters["segmentation"]["foreground"]["MaskMinRadius"]
+                                  * self.parameters["segmentation"]["avgCellDiameter"]
+                                  )
+        return np.logical_not(foreground_mask)
+
+    def spread_background(self, background, background_mask, radiuses, first=True):
+        """
+        Runs background blurring steps, known background pixels are reset to the image after every step.
+        @param radiuses: radiuses of the steps
+        @param first: True if the steps start with the first one (which does not use FFT)
+        """
+        foreground_mask = np.logical_not(background_mask)
+        for i, radius in enumerate(radiuses):
+            background = image_smooth(background, radius, i != 0 or not first)
+            background = background * foreground_mask + self.image * background_mask
+        return background
+
+    def background_smooth_radiuses(self):
+        """
+        @return: radiuses of the consecutive background blurring steps, from the largest
+        """
         smooth_radius = round(self.parameters["segmentation"]["background"]["blur"]
                               * self.parameters["segmentation"]["avgCellDiameter"])
         steps = self.parameters["segmentation"]["background"]["blurSteps"]
+        steps_float = float(steps)
+        return [1 + round(smooth_radius * ((steps_float - i) / steps_float) ** 2) for i in range(steps)]
 
-        for i in range(steps):
-            steps_float = float(steps)
-            background = image_smooth(background, 1 + round(smooth_radius * ((steps_float - i) / steps_float) ** 2), i != 0)
-            background = background * foreground_mask + self.image * background_mask
+    @staticmethod
+    def pyramid_factor(radiuses):
+        """
+        @return: the largest power of two which keeps the first radius at least PYRAMID_MIN_RADIUS pixels
+        in the downsampled image and the number of steps with radius at least twice the factor
+        @rtype: (int, int)
+        """
+        factor = 1
+        while radiuses and radiuses[0] / (2.0 * factor) >= PYRAMID_MIN_RADIUS:
+            factor *= 2
+
+        coarse_steps = len([r for r in radiuses if r >= 2 * factor])
+        if factor == 1:
+            coarse_steps = 0
+        return factor, coarse_steps
+
+    @staticmethod
+    def spread_coarse_background(coarse, known, known_weight, radiuses, factor):
+        """
+        Runs background blurring steps on blocks, where known background pixels take part of the block
+        proportional to their number.
+        @param coarse: downsampled background
+        @param known: downsampled image in known background pixels (zero elsewhere)
+        @param known_weight: downsampled background mask
+        """
+        unknown_weight = 1 - known_weight
+        for radius in radiuses:
+            coarse = image_smooth(coarse, radius / float(factor))
+            coarse = coarse * unknown_weight + known
+        return coarse
+
+    def spread_background_downsampled(self, background, background_mask, radiuses):
+        """
+        Runs the large radius blurring steps on the image downsampled by pyramid_factor. Every step with radius
+        at least twice the factor is done on blocks (see spread_coarse_background). The result is upsampled and
+        the remaining small steps refine it in full resolution.
+
+        Every step (blur with normalized non-negative kernel and reset of the known pixels) is a weighted average,
+        so it never increases the maximal difference between two backgrounds. Hence the difference from the
+        exact background is at most the difference at the moment of upsampling and it only decreases during
+        the refinement. On the bundled example images it is below 0.01 at most and 0.001 on average
+        (images are 0-1 floats), see benchmark_util.benchmark_background.
+        @param background: background before the first step with foreground filled with median
+        @type background_mask: np.ndarray
+        @return: background after the downsampled steps and the index of the first step which is still to be done
+        """
+        factor, coarse_steps = self.pyramid_factor(radiuses)
+        if coarse_steps == 0:
+            return background, 0
 
-        self._background = background
+        coarse = self.spread_coarse_background(image_downsample(background, factor),
+                                               image_downsample(self.image * background_mask, factor),
+                                               image_downsample(background_mask, factor),
+                                               radiuses[:coarse_steps], factor)
+
+        background = image_upsample(coarse, factor, background.shape)
+        background = background * np.logical_not(background_mask) + self.image * background_mask
+        return background, coarse_steps
+
+    def difference_range(self, kind):
+        """
+        @param kind: "clean", "brighter" or "darker" difference of image and background
+        @return: range of the difference used in its normalization, (None, None) for the range of this image
+        """
+        if self.frame_statistics is None:
+            return None, None
+
+        minimum, maximum = self.frame_statistics["difference_range"]
+        if kind == "brighter":
+            return max(minimum, 0), max(maximum, 0)
+        elif kind == "darker":
+            return max(-maximum, 0), max(-minimum, 0)
+        return minimum, maximum
 
     def calculate_clean_original(self):
-        self._clean_original = image_normalize(self.image - self.background)
+        self._clean_original = self.store(image_normalize(self.image - self.background,
+                                                          *self.difference_range("clean")))
 
     def calculate_brighter_original(self):
         self._brighter_original = self.image - self.background
-        self._brighter_original = image_normalize(np.maximum(self._brighter_original, 0))
+        self._brighter_original = self.store(image_normalize(np.maximum(self._brighter_original, 0),
+                                                             *self.difference_range("brighter")))
 
     def calculate_darker_original(self):
         self._darker_original = self.background - self.image
-        self._darker_original = image_normalize(np.maximum(self._darker_original, 0))
+        self._darker_original = self.store(image_normalize(np.maximum(self._darker_original, 0),
+                                                           *self.difference_range("darker")))
 
     def calculate_forebackground_masks(self):
         """
@@ -235,7 +520,7 @@ class ImageRepo(object):
             smooth_coefficient = round(self.parameters["segmentation"]["background"]["computeByBlurring"]
                                        * self.parameters["segmentation"]["avgCellDiameter"])
 
-            temp_blurred = image_smooth(self.image, smooth_coefficient)
+            temp_blurred = image_smooth(self.image, smooth_coefficient, keep_spectrum=True)
             temp_fg_mask = image_normalize(np.abs((self.image - temp_blurred))) > \
                            self.parameters["segmentation"]["foreground"]["MaskThreshold"]
 
@@ -263,22 +548,34 @@ class ImageRepo(object):
                                            * self.parameters["segmentation"]["avgCellDiameter"])
         self._clean = image_smooth(self.image_back_difference, image_diff_med_filter_size)
 
-        clean_mean = self._clean_original.mean()
+        if self.frame_statistics is None:
+            clean_mean = self._clean_original.mean()
+        else:
+            minimum, maximum = self.difference_range("clean")
+            clean_mean = (self.frame_statistics["difference_mean"] - minimum) / ((maximum - minimum) or 1)
         masked = self._clean * self.foreground_mask
         mean_negative_masked = clean_mean * self.background_mask
-        self._clean = masked + mean_negative_masked
+        self._clean = self.store(masked + mean_negative_masked)
 
     def calculate_brighter(self):
         brighter_med_filter_size = np.round(self.parameters["segmentation"]["cellBorder"]["medianFilter"]
                                             * self.parameters["segmentation"]["avgCellDiameter"])
-        self._brighter = image_median_filter(self.brighter_original, brighter_med_filter_size)
-        self._brighter *= self.foreground_mask
+        self._brighter = self.store(image_median_filter(self.brighter_original, brighter_med_filter_size,
+                                                        self.median_filter_levels()) * self.foreground_mask)
 
     def calculate_darker(self):
         darker_med_filter_size = round(self.parameters["segmentation"]["cellContent"]["medianFilter"]
                                        * self.parameters["segmentation"]["avgCellDiameter"])
-        self._darker = image_median_filter(self.darker_original, darker_med_filter_size)
-        self._darker *= self.foreground_mask
+        self._darker = self.store(image_median_filter(self.darker_original, darker_med_filter_size,
+                                                      self.median_filter_levels()) * self.foreground_mask)
+
+    def median_filter_levels(self):
+        """
+        @return: number of levels of histogram median filter or None if scipy median filter is used
+        """
+        if self.parameters["segmentation"]["processing"]["median"] == "histogram":
+            return self.parameters["segmentation"]["processing"]["medianLevels"]
+        return None
 
     def calculate_cell_border_content_mask(self):
         """
@@ -307,12 +604,45 @@ class ImageRepo(object):
 
         self._cell_border_mask = self.foreground_mask & np.logical_not(self.cell_content_mask)
 
-    def get_blurred(self, image, blur_param, cache_result=False):
-        cache = [c for a, b, c in self._blurred if a is image and b == blur_param]
-        if cache:
-            return cache[0]
-        else:
-            blurred = image_blur(image, blur_param)
-            if cache_result:
-                self._blurred.append((image, blur_param, blurred))
+    def modified(self):
+        """
+        Marks that intermediate images were modified in place, so blurred images cached before are not used.
+        """
+        self.generation += 1
+
+    def get_blurred(self, image, blur_param, cache=True):
+        """
+        Blurs image (see image_blur). Blurred images are cached by identity of the image, generation and blur
+        and must not be modified.
+        @param cache: False for images which are not blurred again, they are neither looked up nor kept
+        """
+        def blur():
+            blurred = self.store(image_blur(image, blur_param))
+            blurred.flags.writeable = False
             return blurred
+
+        if not cache:
+            return blur()
+
+        self.fit_blur_cache()
+        blurred = self._blurred.get((self.generation, blur_param), blur, image)
+        self.peak_bytes = max(self.peak_bytes, self.nbytes)
+        return blurred
+
+    def fit_blur_cache(self):
+        """
+        Limits blurred images cache to processing blurCacheMB and to the part of memory budget
+        not used by other images.
+        """
+        max_bytes = self.parameters["segmentation"]["processing"]["blurCacheMB"] * 2 ** 20
+        budget = self.memory_budget()
+        if budget is not None:
+            max_bytes = min(max_bytes, max(0, budget - (self.nbytes - self._blurred.nbytes)))
+        self._blurred.resize(max_bytes)
+
+    def blur_cache_statistics(self):
+        """
+        @return: number of hits, misses and evictions and the number and memory of cached blurred images
+        @rtype: dict
+        """
+        return self._blurred.statistics()
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """
-Parallel is an attempt to use multiprocessing in snake growing thus improving the speed of the segmentation.
-Currently not tested and on hold.
+Parallel uses pools of processes or threads in snake growing and evaluation thus improving the speed of the segmentation.
 Date: 2015-2016
 Website: http://cellstar-algorithm.org/
 """
+__all__ = ["snake_grow"]
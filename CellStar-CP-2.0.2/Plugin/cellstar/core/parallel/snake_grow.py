@@ -1,106 +1,322 @@
 # -*- coding: utf-8 -*-
 """
-Snake grow is an attempt to run time expensive snake in parallel using multiprocessing package.
-Currently not tested and on hold. Tried only once for parameter fitting.
+Snake grow runs time expensive snake growing and evaluation in a pool of processes or threads.
+For processes images are published once per frame through shared memory and workers return compact results.
+Threads work directly on the images and snakes of the segmentation.
 Date: 2015-2016
 Website: http://cellstar-algorithm.org/
 """
 
-import ctypes
-from copy import copy
-from multiprocessing import Pool, Array, Manager
+import multiprocessing
+import multiprocessing.pool
+import os
 
 import numpy as np
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+from cellstar.core.batch_grow import BatchGrower
 from cellstar.core.image_repo import ImageRepo
 from cellstar.core.polar_transform import PolarTransform
+from cellstar.core.seed import Seed
 from cellstar.core.snake import Snake
-from cellstar.parameter_fitting.pf_snake import PFSnake
+
+# snake properties determined by growing and evaluation which are sent back from workers
+GROWN_PROPERTIES = ["polar_coordinate_boundary", "original_edgepoints", "final_edgepoints",
+                    "in_polygon", "in_polygon_yx", "rank", "area",
+                    "avg_out_border_brightness", "max_out_border_brightness", "avg_in_border_brightness",
+                    "avg_inner_brightness", "max_inner_brightness", "avg_inner_darkness",
+                    "centroid_x", "centroid_y", "max_contiguous_free_border", "free_border_entropy"]
+
+# snake properties needed to evaluate already grown snake
+EVALUATION_INPUT_PROPERTIES = ["polar_coordinate_boundary", "original_edgepoints", "final_edgepoints"]
+
+
+def is_available():
+    return shared_memory is not None
+
+
+def workers_number(parameters):
+    workers = parameters["segmentation"]["processing"]["workers"]
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13, workers share resource tracker with the pool owner which unlinks memory
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedImageRepo(object):
+    """
+    Copy of ImageRepo intermediate images used in snake growing and evaluation placed in shared memory.
+    """
+
+    # ImageRepo fields required by Snake.grow and Snake.evaluate
+    fields = ["image", "_clean", "_clean_original", "_brighter", "_foreground_mask", "_cell_content_mask"]
+
+    def __init__(self, images):
+        """
+        @type images: cellstar.core.image_repo.ImageRepo
+        """
+        # make sure that all required images are calculated
+        arrays = {
+            "image": images.image,
+            "_clean": images.image_back_difference_blurred,
+            "_clean_original": images.image_back_difference,
+            "_brighter": images.brighter,
+            "_foreground_mask": images.foreground_mask,
+            "_cell_content_mask": images.cell_content_mask,
+        }
+
+        self.shared_memory = []
+        self.descriptor = []
+        try:
+            for field in self.fields:
+                array = np.ascontiguousarray(arrays[field])
+                shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+                self.shared_memory.append(shm)
+                np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+                self.descriptor.append((field, shm.name, array.shape, array.dtype.str))
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        for shm in self.shared_memory:
+            shm.close()
+            shm.unlink()
+        self.shared_memory = []
+
+    @staticmethod
+    def attach(descriptor, parameters):
+        """
+        Recreate image repository from shared memory.
+        @return: image repository and shared memory blocks which have to be kept alive while it is used
+        @rtype: (ImageRepo, list)
+        """
+        blocks = []
+        arrays = {}
+        for field, name, shape, dtype in descriptor:
+            shm = attach_shared_memory(name)
+            blocks.append(shm)
+            arrays[field] = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+
+        images = ImageRepo(arrays.pop("image"), parameters)
+        for field, array in arrays.items():
+            setattr(images, field, array)
+        return images, blocks
+
+
+#
+#
+# WORKER
+#
+#
+
+_worker_state = {}
+
+
+def init_worker(descriptor, parameters):
+    images, blocks = SharedImageRepo.attach(descriptor, parameters)
+    _worker_state["images"] = images
+    _worker_state["blocks"] = blocks
+    _worker_state["parameters"] = parameters
+    _worker_state["polar_transform"] = PolarTransform.instance(parameters["segmentation"]["avgCellDiameter"],
+                                                               parameters["segmentation"]["stars"]["points"],
+                                                               parameters["segmentation"]["stars"]["step"],
+                                                               parameters["segmentation"]["stars"]["maxSize"])
+
+
+def snake_result(snake):
+    return tuple(getattr(snake, name) for name in GROWN_PROPERTIES)
+
+
+def create_worker_snake(x, y):
+    parameters = _worker_state["parameters"]
+    seed = Seed(x, y, "worker")
+    return Snake.create_from_seed(parameters, seed, parameters["segmentation"]["stars"]["points"],
+                                  _worker_state["images"])
+
+
+def grow_seeds(xys):
+    """
+    Grow snakes from given seeds with all size weights and return results of the best ones.
+    @param xys: seeds coordinates
+    @type xys: np.ndarray
+    """
+    parameters = _worker_state["parameters"]
+    polar_transform = _worker_state["polar_transform"]
+    grower = BatchGrower(_worker_state["images"], parameters, polar_transform)
+
+    snakes = [create_worker_snake(x, y) for x, y in xys]
+    best_snakes = grower.grow_best(snakes, parameters["segmentation"]["stars"]["sizeWeight"])
+    return [snake_result(snake) for snake in best_snakes]
 
 
-def conv_single_image(image):
-    shared_array_base = Array(ctypes.c_double, image.size)
-    shared_array = np.ctypeslib.as_array(shared_array_base.get_obj())
-    shared_array = shared_array.reshape(image.shape)
-    shared_array[:] = image
+def evaluate_grown(task):
+    """
+    Evaluate already grown snakes.
+    @param task: seeds coordinates and snakes grow properties (see EVALUATION_INPUT_PROPERTIES)
+    """
+    xys, grown_properties = task
+    results = []
+    for (x, y), properties in zip(xys, grown_properties):
+        snake = create_worker_snake(x, y)
+        for name, value in zip(EVALUATION_INPUT_PROPERTIES, properties):
+            setattr(snake, name, value)
+        snake.set_points_from_boundary(_worker_state["polar_transform"])
+        snake.evaluate(_worker_state["polar_transform"])
+        results.append(snake_result(snake))
+    return results
 
-    return shared_array
 
+#
+#
+# POOLS
+#
+#
 
-def conv_image_repo(images):
-    return map(conv_single_image, [
-        images.foreground_mask,
-        images.brighter,
-        images.darker,
-        images.image_back_difference_blurred,
-        images.image_back_difference,
-        images.cell_content_mask,
-        images.cell_border_mask,
-        images.background,
-        images.background_mask
-    ])
+class PoolGrower(object):
+    """
+    Base of pools growing and evaluating snakes for one frame.
+    Snakes are split into chunks which are processed concurrently, results are collected in the original order.
+    """
 
+    # number of chunks per worker, more chunks balance the load better
+    chunks_per_worker = 4
 
-def grow_single_snake(frame, images, parameters, seed):
-    #
-    #
-    # RECONSTRUCT INPUT
-    #
-    #
+    def __init__(self, workers):
+        self.workers = workers
 
-    ir = ImageRepo(frame, parameters)
-    ir._foreground_mask, ir._brighter, ir._darker, ir._clean, ir._clean_original, \
-    ir._cell_content_mask, ir._cell_border_mask, ir._background, ir._background_mask = images
+    def split(self, items):
+        chunk_size = max(1, int(np.ceil(len(items) / float(self.workers * self.chunks_per_worker))))
+        return [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
 
-    #
-    #
-    # CREATE AND GROW SNAKE
-    #
-    #
 
-    polar_transform = PolarTransform.instance(parameters["segmentation"]["avgCellDiameter"],
-                                              parameters["segmentation"]["stars"]["points"],
-                                              parameters["segmentation"]["stars"]["step"],
-                                              parameters["segmentation"]["stars"]["maxSize"])
+class ThreadPoolGrower(PoolGrower):
+    """
+    Pool of threads growing and evaluating snakes for one frame. Most of the work is done by NumPy
+    which releases GIL, while images are shared without copying or pickling.
+    """
 
-    s = Snake.create_from_seed(parameters, seed, parameters["segmentation"]["stars"]["points"], ir)
+    def __init__(self, images, parameters, polar_transform, workers):
+        """
+        @type images: cellstar.core.image_repo.ImageRepo
+        @type parameters: dict
+        @type polar_transform: cellstar.core.polar_transform.PolarTransform
+        @param workers: number of threads
+        """
+        super(ThreadPoolGrower, self).__init__(workers)
+        self.parameters = parameters
+        self.grower = BatchGrower(images, parameters, polar_transform)
 
-    size_weight_list = parameters["segmentation"]["stars"]["sizeWeight"]
-    snakes_to_grow = [(copy(s), w) for w in size_weight_list]
+        # calculate lazy images up front so that threads only read them
+        images.image_back_difference_blurred
+        images.image_back_difference
+        images.brighter
+        images.foreground_mask
+        images.cell_content_mask
 
-    for snake, weight in snakes_to_grow:
-        snake.grow(size_weight=weight, polar_transform=polar_transform)
-        snake.evaluate(polar_transform)
+        self.pool = multiprocessing.pool.ThreadPool(processes=workers)
 
-    best_snake = sorted(snakes_to_grow, key=lambda (sn, _): sn.rank)[0][0]
+    def grow_chunk(self, snakes):
+        return self.grower.grow_best(snakes, self.parameters["segmentation"]["stars"]["sizeWeight"])
 
-    pf_s = PFSnake(None, None, None, best_snake=best_snake)
-    pf_s.best_snake = best_snake
+    def evaluate_chunk(self, snakes):
+        for snake in snakes:
+            snake.evaluate(self.grower.polar_transform)
 
-    return pf_s
+    def grow(self, snakes, polar_transform):
+        """
+        Grow snakes with all size weights and keep the best ones.
+        @type snakes: list[cellstar.core.snake.Snake]
+        @return: best grown snake for every given snake
+        @rtype: list[cellstar.core.snake.Snake]
+        """
+        grown_snakes = []
+        for chunk_snakes in self.pool.map(self.grow_chunk, self.split(snakes)):
+            grown_snakes += chunk_snakes
+        return grown_snakes
 
+    def evaluate(self, snakes, polar_transform):
+        """
+        Evaluate grown snakes, snakes are modified in place.
+        @type snakes: list[cellstar.core.snake.Snake]
+        """
+        self.pool.map(self.evaluate_chunk, self.split(snakes))
 
-def grow_fun((seed, frame, images, parameters)):
-    return grow_single_snake(frame, images, parameters, seed)
+    def close(self):
+        self.pool.close()
+        self.pool.join()
 
 
-def add_snake(snakes, snake):
-    snakes.append(snake)
+class ProcessPoolGrower(PoolGrower):
+    """
+    Pool of processes growing and evaluating snakes for one frame.
+    """
 
+    def __init__(self, images, parameters, workers):
+        """
+        @type images: cellstar.core.image_repo.ImageRepo
+        @type parameters: dict
+        @param workers: number of processes
+        """
+        super(ProcessPoolGrower, self).__init__(workers)
+        self.shared_images = SharedImageRepo(images)
+        try:
+            self.pool = multiprocessing.Pool(processes=workers, initializer=init_worker,
+                                             initargs=(self.shared_images.descriptor, parameters))
+        except:
+            self.shared_images.close()
+            raise
 
-def mp_snake_grow(images, parameters, seeds):
-    snakes = []
-    manager = Manager()
-    shared_parameters = manager.dict(parameters)
-    shared_images = conv_image_repo(images)
-    shared_frame = conv_single_image(images.image)
+    @staticmethod
+    def seeds_coordinates(snakes):
+        return np.array([(s.seed.x, s.seed.y) for s in snakes], dtype=float).reshape((-1, 2))
 
-    snakes = []
+    @staticmethod
+    def apply_results(snakes, results, polar_transform):
+        for snake, result in zip(snakes, results):
+            for name, value in zip(GROWN_PROPERTIES, result):
+                setattr(snake, name, value)
+            snake.properties_vector_cached = {}
+            snake.set_points_from_boundary(polar_transform)
 
-    pool = Pool(processes=8)
-    snakes = pool.map_async(grow_fun, [(seed, shared_frame, shared_images, shared_parameters) for seed in seeds]).get()
-    pool.close()
-    pool.join()
+    def grow(self, snakes, polar_transform):
+        """
+        Grow snakes with all size weights and keep the best one, snakes are modified in place.
+        @type snakes: list[cellstar.core.snake.Snake]
+        @return: given snakes
+        @rtype: list[cellstar.core.snake.Snake]
+        """
+        chunks = self.split(snakes)
+        results = self.pool.map(grow_seeds, [self.seeds_coordinates(chunk) for chunk in chunks])
+        for chunk, chunk_results in zip(chunks, results):
+            self.apply_results(chunk, chunk_results, polar_transform)
+        return snakes
 
-    return snakes
+    def evaluate(self, snakes, polar_transform):
+        """
+        Evaluate grown snakes, snakes are modified in place.
+        @type snakes: list[cellstar.core.snake.Snake]
+        """
+        snakes = [s for s in snakes if s.rank is None]
+        chunks = self.split(snakes)
+        tasks = [(self.seeds_coordinates(chunk),
+                  [tuple(getattr(s, name) for name in EVALUATION_INPUT_PROPERTIES) for s in chunk])
+                 for chunk in chunks]
+        results = self.pool.map(evaluate_grown, tasks)
+        for chunk, chunk_results in zip(chunks, results):
+            self.apply_results(chunk, chunk_results, polar_transform)
 
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.shared_images.close()
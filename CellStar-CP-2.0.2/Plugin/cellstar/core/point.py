@@ -14,6 +14,8 @@ class Point(object):
     @ivar y: y coordinate of point
     """
 
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         """
         @type x: int
@@ -5,14 +5,19 @@ Date: 2013-2016
 Website: http://cellstar-algorithm.org/
 """
 
+import hashlib
+import logging
 import math
+import os
+import tempfile
 import threading
+from collections import OrderedDict
 
 import numpy as np
 
 from cellstar.utils.calc_util import to_int
-from cellstar.utils.calc_util import sub2ind
-from cellstar.utils.image_util import image_dilate_with_element, get_circle_kernel
+
+logger = logging.getLogger(__name__)
 
 
 class PolarTransform(object):
@@ -57,30 +62,71 @@ class PolarTransform(object):
     @ivar y: cartesian y-coordinates of points in polar coordinates system
     coordinates ordered by radius of polar points --> y[r,a] = P(r,a).y
 
-    @type dot_voronoi: numpy.array
-    @ivar dot_voronoi - voronoi - "gravity field" of contour points
-    dot_voronoi[x,y] = id(closest_contour_point(x,y))
-
-    @type to_polar: dict
-    @ivar to_polar - dictionary of lists
-    for each point:
-    to_polar[index(P(R,a)] - list of point id in voronoi of contour points {P(r,a)| 0 < r < R}
-    to_polar[index(P(R,a)] = [gravity_field(dot_voronoi, p) for p in {P(r,a) | 0 < r < R}]
-    to_polar[index(P(R,a)] =
-        [index(x,y) for x,y in range((0,0),(edge,edge)) if dot_voronoi[x,y] == gravity_index(p) for p in {P(r,a) | 0 < r < R}]
+    @type pixel_rays: numpy.array
+    @ivar pixel_rays - for every pixel of polar transform square [edge x edge] (centered at 'center' - 1)
+    index of the ray preceding it (clockwise)
+
+    @type pixel_ray_coordinates: numpy.array
+    @ivar pixel_ray_coordinates - coordinates (v, u) of every pixel in the base of the rays surrounding it,
+    in steps: pixel = v * ray(a) + u * ray(a + 1) where a = pixel_rays[pixel]
     """
 
+    # version of the tables stored in the disk cache, has to be increased when their calculation changes
+    cache_version = 2
+    # directory of the disk cache of tables, the cache is used only if it is set (e.g. by CELLSTAR_CACHE_DIR)
+    cache_directory = os.environ.get("CELLSTAR_CACHE_DIR") or None
+    cached_tables = ["pixel_rays", "pixel_ray_coordinates"]
+
+    # limits of the number and memory of instances kept by instance()
+    max_instances = 8
+    max_instances_bytes = 256 * 2 ** 20
+
     __singleton_lock = threading.Lock()
-    __singleton_instances = {}
+    __singleton_instances = OrderedDict()
+    __singleton_statistics = {"hits": 0, "misses": 0, "evictions": 0}
 
     @classmethod
     def instance(cls, avg_cell_diameter, points, step, max_size):
+        """
+        Get shared instance for given parameters. Instances are kept in least recently used order and
+        the oldest ones are dropped when there is more than max_instances of them or they use more than
+        max_instances_bytes of memory (the most recent one is always kept).
+        @rtype: PolarTransform
+        """
         init_params = avg_cell_diameter, points, step, max_size
-        if not cls.__singleton_instances.get(init_params, False):
-            with cls.__singleton_lock:
-                if not cls.__singleton_instances.get(init_params, False):
-                    cls.__singleton_instances[init_params] = cls(avg_cell_diameter, points, step, max_size)
-        return cls.__singleton_instances.get(init_params, None)
+        with cls.__singleton_lock:
+            instance = cls.__singleton_instances.pop(init_params, None)
+            if instance is not None:
+                cls.__singleton_statistics["hits"] += 1
+            else:
+                cls.__singleton_statistics["misses"] += 1
+                instance = cls(avg_cell_diameter, points, step, max_size)
+            cls.__singleton_instances[init_params] = instance
+
+            while len(cls.__singleton_instances) > 1 and \
+                    (len(cls.__singleton_instances) > cls.max_instances or
+                     sum(i.nbytes for i in cls.__singleton_instances.values()) > cls.max_instances_bytes):
+                cls.__singleton_instances.popitem(last=False)
+                cls.__singleton_statistics["evictions"] += 1
+
+            return instance
+
+    @classmethod
+    def instance_statistics(cls):
+        """
+        @return: number of hits, misses and evictions of instance() and the number and memory of kept instances
+        @rtype: dict
+        """
+        with cls.__singleton_lock:
+            statistics = dict(cls.__singleton_statistics)
+            statistics["instances"] = len(cls.__singleton_instances)
+            statistics["bytes"] = sum(i.nbytes for i in cls.__singleton_instances.values())
+        return statistics
+
+    @classmethod
+    def clear_instances(cls):
+        with cls.__singleton_lock:
+            cls.__singleton_instances.clear()
 
     def __init__(self, avg_cell_diameter, points_number, step, max_size):
         self.N = points_number
@@ -96,9 +142,10 @@ class PolarTransform(object):
         self.x = None
         self.y = None
 
-        self.dot_voronoi = None
-        self.to_polar = {}
+        self.pixel_rays = None
+        self.pixel_ray_coordinates = None
 
+        self.cache_key = repr((avg_cell_diameter, points_number, step, max_size))
         self._calculate_polar_transform()
 
     def _calculate_polar_transform(self):
@@ -126,46 +173,179 @@ class PolarTransform(object):
         self.center = to_int(self.half_edge + 1)
         self.edge = to_int(self.center + self.half_edge)
 
-        # clear black image [edge x edge]
-        self.dot_voronoi = np.zeros((self.edge, self.edge), dtype=int)
-        px = self.center + self.x
-        py = self.center + self.y
-
-        # create list of coordinates (x,y) on the checked contour
-        index = np.column_stack(((py - .5).astype(int).T.flat, (px - .5).astype(int).T.flat))
-
-        # create list of subsequent id for above points
-        cont = np.arange(1, px.size + 1)
-
-        # mark on 'dot_voronoi' every point using unique id
-        self.dot_voronoi[tuple(index.T)] = cont
-
-        # in every iteration smooth 'dot_voronoi' marking gravity field of given points
-        for i in range(0, int(self.center)):
-            ndv = image_dilate_with_element(self.dot_voronoi, 3)
-            mask = np.logical_and((self.dot_voronoi == 0), (ndv != 0))
-            mask = mask.nonzero()
-            self.dot_voronoi[mask] = ndv[mask]
-
-        # apply circle mask on 'dot_voronoi'
-        circ_mask = get_circle_kernel(self.half_edge)
-        self.dot_voronoi[np.logical_not(circ_mask)] = 0
-        self.dot_voronoi[self.center - 1, self.center - 1] = 0
-
-        # for every angle
-        for a in range(self.t.size):
-            # create new clear mask
-            mask = np.zeros((self.edge, self.edge), dtype=bool)
-            # for point
-            for r in range(self.R.size):
-                # find index of point P(r,a)
-                idx = sub2ind(px.shape[0], (r, a))
-                val = idx + 1
-                # find places which belong to that index in 'dot_voronoi'
-                indices = np.array(list(zip(*np.nonzero(self.dot_voronoi == val))))
-                # set mask to 1 in above places
-                if len(indices) > 0:
-                    mask[tuple(indices.T)] = 1
-
-                # to_polar[idx] is a list of coordinates (x,y) from points on the mask
-                self.to_polar[idx] = map(lambda pair: pair, zip(*np.nonzero(mask)))
+        if not self._load_tables():
+            self._calculate_tables()
+            self._save_tables()
+
+    def _calculate_tables(self):
+        # position of every pixel in relation to the surrounding rays used to rasterize star polygons (see StarPatch)
+        angle_step = 2 * math.pi / self.N
+        offsets = np.arange(self.edge) - (self.center - 1)
+        pixel_y, pixel_x = np.meshgrid(offsets, offsets, indexing='ij')
+        pixel_angle = np.mod(np.arctan2(pixel_y, pixel_x), 2 * math.pi)
+        pixel_radius = np.hypot(pixel_y, pixel_x) / self.step
+        self.pixel_rays = np.minimum((pixel_angle // angle_step).astype(int), self.N - 1)
+        ray_angle = self.t[self.pixel_rays]
+        self.pixel_ray_coordinates = np.array([pixel_radius * np.sin(ray_angle + angle_step - pixel_angle),
+                                               pixel_radius * np.sin(pixel_angle - ray_angle)]) / math.sin(angle_step)
+
+    def _cache_path(self):
+        if not self.cache_directory:
+            return None
+        key_hash = hashlib.sha1(self.cache_key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_directory, "polar_transform_v%d_%s.npz" % (self.cache_version, key_hash))
+
+    def _load_tables(self):
+        """
+        Load tables from the disk cache.
+        @return: True if tables were loaded
+        """
+        path = self._cache_path()
+        if path is None or not os.path.exists(path):
+            return False
+
+        if not (self._is_private(self.cache_directory) and self._is_private(path)):
+            logger.warning("Polar transform tables in %s are not used, they can be modified by other users." % path)
+            return False
+
+        try:
+            with np.load(path, allow_pickle=False) as cached:
+                if int(cached["version"]) != self.cache_version or str(cached["key"]) != self.cache_key:
+                    return False
+                tables = dict((name, cached[name]) for name in self.cached_tables)
+        except Exception as e:
+            logger.debug("Could not load polar transform tables from %s: %s" % (path, e))
+            return False
+
+        for name, table in tables.items():
+            setattr(self, name, table)
+        return True
+
+    @staticmethod
+    def _is_private(path):
+        """
+        @return: True if the path is owned by the current user and others cannot write to it
+        """
+        if not hasattr(os, "getuid"):  # Windows
+            return True
+        info = os.stat(path)
+        return info.st_uid == os.getuid() and not info.st_mode & 0o022
+
+    def _save_tables(self):
+        """
+        Store tables in the disk cache, the file is replaced atomically so concurrent workers never read partial one.
+        """
+        path = self._cache_path()
+        if path is None:
+            return
+
+        temp_path = None
+        try:
+            if not os.path.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory, 0o700)
+            handle, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_directory)
+            with os.fdopen(handle, "wb") as temp_file:
+                np.savez(temp_file, version=self.cache_version, key=self.cache_key,
+                         **dict((name, getattr(self, name)) for name in self.cached_tables))
+            if hasattr(os, "replace"):
+                os.replace(temp_path, path)
+            else:  # Python 2
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(temp_path, path)
+            temp_path = None
+        except (IOError, OSError) as e:
+            logger.debug("Could not store polar transform tables in %s: %s" % (path, e))
+        finally:
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @property
+    def nbytes(self):
+        """
+        @return: memory used by the tables of polar transform
+        """
+        return sum(getattr(self, name).nbytes for name in self.cached_tables) + self.x.nbytes + self.y.nbytes
+
+
+class StarPatch(object):
+    """
+    Square of pixels around the origin of star polygons. Star polygons are rasterized by lookup
+    in polar transform tables instead of drawing them, so the polygon with its dilations and erosions
+    are calculated in a single lookup of their edges for every pixel.
+
+    @type slices: (slice, slice)
+    @ivar slices: position of the patch in the image
+    """
+
+    def __init__(self, polar_transform, origin_x, origin_y, max_radius, max_yx, buffers=None):
+        """
+        @type polar_transform: PolarTransform
+        @param max_radius: maximal boundary (radius index) of the polygons rasterized in patch
+        @param max_yx: shape of the image, patch is cropped to it
+        @param buffers: scratch buffers used for intermediate results
+        @type buffers: cellstar.utils.calc_util.ScratchBuffers
+        """
+        max_y, max_x = max_yx
+        origin = polar_transform.center - 1
+        center_y = int(np.round(origin_y))
+        center_x = int(np.round(origin_x))
+        half_size = min(origin, int(math.ceil(max_radius * polar_transform.step)) + 1)
+
+        y1 = min(max(0, center_y - half_size), max_y)
+        y2 = max(min(max_y, center_y + half_size + 1), y1)
+        x1 = min(max(0, center_x - half_size), max_x)
+        x2 = max(min(max_x, center_x + half_size + 1), x1)
+        self.slices = (slice(y1, y2), slice(x1, x2))
+
+        table_slice = (slice(y1 - center_y + origin, y2 - center_y + origin),
+                       slice(x1 - center_x + origin, x2 - center_x + origin))
+        self.rays = polar_transform.pixel_rays[table_slice]
+        self.ray_coordinates = polar_transform.pixel_ray_coordinates[(slice(None),) + table_slice]
+        self.shape = self.rays.shape
+        self.buffers = buffers
+
+        self.ray_x = np.cos(polar_transform.t)
+        self.ray_y = np.sin(polar_transform.t)
+        self.next_ray = np.roll(np.arange(polar_transform.N), -1)
+        self.outline_scale = 0.5 / (polar_transform.step * math.sin(2 * math.pi / polar_transform.N))
+
+    def buffer(self, name, shape):
+        if self.buffers is None:
+            return np.empty(shape)
+        return self.buffers.get(name, shape, float)
+
+    def masks(self, boundaries, out=None):
+        """
+        Rasterize star polygons. Pixel belongs to the polygon if it is inside the polygon edge between
+        the rays surrounding it or it would be drawn as the outline of that edge, i.e. it is less than half
+        of the pixel off the edge along the minor axis of the edge.
+        @param boundaries: radius index for every angle (rows are polygons)
+        @type boundaries: np.ndarray
+        @param out: optional array of shape (polygons,) + patch shape for the masks
+        @return: mask of every polygon
+        @rtype: np.ndarray
+        """
+        b0 = np.asarray(boundaries, dtype=float)
+        b1 = b0[:, self.next_ray]
+        edge_x = np.abs(b1 * self.ray_x[self.next_ray] - b0 * self.ray_x)
+        edge_y = np.abs(b1 * self.ray_y[self.next_ray] - b0 * self.ray_y)
+        limit = b0 * b1 + self.outline_scale * np.maximum(edge_x, edge_y)
+
+        # edges of all polygons between the rays surrounding every pixel are gathered at once,
+        # indices are always valid, wrap mode lets take write directly to the buffer
+        edges = np.array([b0, b1, limit])
+        gathered = self.buffer("star_patch_gathered", edges.shape[:2] + self.shape)
+        np.take(edges, self.rays, axis=2, out=gathered, mode="wrap")
+        if out is None:
+            out = np.empty(gathered.shape[1:], dtype=bool)
+
+        # polygons one by one, broadcasting the coordinates would allocate ufunc buffers
+        v, u = self.ray_coordinates
+        distance = self.buffer("star_patch_distance", self.shape)
+        for start, end, end_limit, mask in zip(gathered[0], gathered[1], gathered[2], out):
+            np.multiply(start, u, out=distance)
+            end *= v
+            distance += end
+            np.less_equal(distance, end_limit, out=mask)
+        return out
@@ -5,6 +5,10 @@ Date: 2013-2016
 Website: http://cellstar-algorithm.org/
 """
 
+import threading
+
+import numpy as np
+
 from cellstar.core.point import Point
 
 
@@ -16,6 +20,8 @@ class Seed(Point):
     @ivar origin: where seed comes from ('content' or 'background' or 'snakes')
     """
 
+    __slots__ = ("origin",)
+
     def __init__(self, x, y, origin):
         """
         @type x: int
@@ -25,4 +31,131 @@ class Seed(Point):
         self.origin = origin
 
     def __hash__(self):
-        return hash((self.x, self.y, self.origin))
\ No newline at end of file
+        return hash((self.x, self.y, self.origin))
+
+
+class SeedBatch(object):
+    """
+    Compact representation of many seeds used in the seeding pipeline.
+    Coordinates are kept in arrays and origins as codes of names registered in the class,
+    Seed objects are created only when seeds are accessed one by one.
+    @ivar x: x coordinates of seeds
+    @type x: np.ndarray
+    @ivar y: y coordinates of seeds
+    @type y: np.ndarray
+    @ivar origin: origin codes of seeds (see origin_name)
+    @type origin: np.ndarray
+    """
+
+    __slots__ = ("x", "y", "origin")
+
+    # names of registered origins, code of an origin is its index
+    origin_names = []
+    origin_codes = {}
+    origin_lock = threading.Lock()
+
+    def __init__(self, x, y, origin):
+        """
+        @param x: x coordinates of seeds
+        @param y: y coordinates of seeds
+        @param origin: origin name or array of origin codes
+        """
+        self.x = np.asarray(x).reshape(-1)
+        self.y = np.asarray(y).reshape(-1)
+        if isinstance(origin, str):
+            origin = np.full(len(self.x), self.origin_code(origin), dtype=np.int16)
+        self.origin = np.asarray(origin, dtype=np.int16).reshape(-1)
+
+    @classmethod
+    def origin_code(cls, name):
+        code = cls.origin_codes.get(name)
+        if code is None:
+            with cls.origin_lock:
+                code = cls.origin_codes.get(name)
+                if code is None:
+                    code = len(cls.origin_names)
+                    cls.origin_names.append(name)
+                    cls.origin_codes[name] = code
+        return code
+
+    @classmethod
+    def origin_name(cls, code):
+        return cls.origin_names[code]
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype=np.int16))
+
+    @classmethod
+    def from_points(cls, points_xy, origin):
+        """
+        @param points_xy: (n x 2) array of (x, y) coordinates
+        @param origin: name of seeds origin
+        """
+        points_xy = np.asarray(points_xy).reshape((-1, 2))
+        return cls(points_xy[:, 0], points_xy[:, 1], origin)
+
+    @classmethod
+    def from_seeds(cls, seeds):
+        """
+        @type seeds: list[Seed]
+        """
+        if len(seeds) == 0:
+            return cls.empty()
+        return cls(np.array([s.x for s in seeds]), np.array([s.y for s in seeds]),
+                   [cls.origin_code(s.origin) for s in seeds])
+
+    @classmethod
+    def concatenate(cls, batches):
+        """
+        @type batches: list[SeedBatch]
+        """
+        batches = [batch for batch in batches if len(batch) > 0]
+        if len(batches) == 0:
+            return cls.empty()
+        return cls(np.concatenate([batch.x for batch in batches]), np.concatenate([batch.y for batch in batches]),
+                   np.concatenate([batch.origin for batch in batches]))
+
+    @property
+    def xy(self):
+        """
+        @return: (n x 2) array of (x, y) coordinates as floats
+        @rtype: np.ndarray
+        """
+        return np.column_stack((self.x, self.y)).astype(float).reshape((-1, 2))
+
+    def select(self, index):
+        """
+        @param index: boolean mask or indices of seeds
+        @rtype: SeedBatch
+        """
+        return SeedBatch(self.x[index], self.y[index], self.origin[index])
+
+    def keys(self):
+        """
+        @return: (x, y, origin) tuple identifying every seed
+        @rtype: list[tuple]
+        """
+        return list(zip(self.x.tolist(), self.y.tolist(), self.origin.tolist()))
+
+    def seed(self, i):
+        return Seed(self.x[i], self.y[i], self.origin_names[self.origin[i]])
+
+    def to_seeds(self):
+        """
+        @rtype: list[Seed]
+        """
+        return [self.seed(i) for i in range(len(self))]
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, i):
+        return self.seed(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.seed(i)
+
+    def __add__(self, other):
+        return SeedBatch.concatenate([self, other])
@@ -4,9 +4,9 @@ Seeder is responsible for finding places where might be cells.
 Date: 2013-2016
 Website: http://cellstar-algorithm.org/
 """
-import random
+from scipy.spatial import cKDTree
 
-from cellstar.core.seed import Seed
+from cellstar.core.seed import SeedBatch
 from cellstar.utils.calc_util import *
 from cellstar.utils.image_util import *
 
@@ -16,14 +16,15 @@ class Seeder(object):
     Find places for seeds based on images and previously found snakes.
     """
 
-    def __init__(self, images, parameters):
+    def __init__(self, images, parameters, generator):
         """
         @type images: core.image_repo.ImageRepo
         @type parameters: dict
+        @param generator: random generator used to draw random seeds
+        @type generator: np.random.Generator
         """
         self.images = images
-        np.random.seed(abs(np.sum(images.image).astype(np.int64)))
-        random.seed(abs(np.sum(images.image).astype(np.int64)))
+        self.random_generator = generator
         self.parameters = parameters
         self.cluster_min_distance = self.parameters["segmentation"]["seeding"]["minDistance"] \
                                     * self.parameters["segmentation"]["avgCellDiameter"]
@@ -32,41 +33,19 @@ class Seeder(object):
 
     def cluster_seeds(self, seeds):
         """
-        @type seeds: list[Seed]
+        @type seeds: SeedBatch
+        @rtype: SeedBatch
         """
         origin = 'cluster'
         if len(seeds) > 0:
-            origin = seeds[0].origin
-        seeds = np.array(list(map(lambda s: (s.x, s.y), seeds)))
-        my_inf = \
-            np.inf if seeds.dtype.kind == 'f' else np.iinfo(seeds.dtype).max
+            origin = SeedBatch.origin_name(seeds.origin[0])
+        seeds = np.column_stack((seeds.x, seeds.y))
         while len(seeds) > 1:
             #
             # find p1 and p2 closest to each other - p1 is closest to p2
-            # and p2 is closest to p1
+            # and p2 is closest to p1 - which are closer than self.cluster_min_distance
             #
-            p1 = np.arange(seeds.shape[0])
-            d = seeds[:, np.newaxis, :] - seeds[np.newaxis, :, :]
-            d2 = np.sum(d * d, 2)
-            d2[p1, p1] = my_inf
-            p2 = np.argmin(d2, 0)
-            #
-            # Eliminate p1 / p2 if p1 is closest to p2 and p2 is closest to
-            # someone else
-            #
-            good = p1 == p2[p2]
-            p1, p2 = p1[good], p2[good]
-            #
-            # Eliminate p1 / p2 if p1 > p2 (get rid of (2, 1) since there is
-            # a (1, 2)
-            #
-            good = p1 < p2
-            p1, p2 = p1[good], p2[good]
-            #
-            # Eliminate p1 / p2 if < self.cluster_min_distance
-            #
-            good = d2[p1, p2] < self.cluster_min_distance
-            p1, p2 = p1[good], p2[good]
+            p1, p2 = mutual_nearest_pairs(seeds, self.cluster_min_distance)
             if len(p1) == 0:
                 break
             #
@@ -78,31 +57,31 @@ class Seeder(object):
             to_keep[p2] = False
             seeds = np.vstack((seeds[to_keep, :], new_seeds))
 
-        seed_points = point_list_as_seeds(seeds, origin)
-        return seed_points
+        return SeedBatch.from_points(seeds, origin)
 
     @staticmethod
-    def rand_seeds(max_random_radius, times, seeds, min_random_radius=0):
+    def rand_seeds(max_random_radius, times, seeds, generator, min_random_radius=0):
         """
         Generate (len(seeds) * times) random seeds within (min_random_radius:max_random_radius).
-        @type seeds: list[Seed]
+        @type seeds: SeedBatch
+        @param generator: random generator used to draw seeds
+        @type generator: np.random.Generator
+        @rtype: SeedBatch
         """
+        shuffled = generator.permutation(len(seeds))
+        fraction_number = int((times - int(times)) * len(seeds))
+        index = np.concatenate([shuffled] * int(times) + [shuffled[:fraction_number]])
+        px = seeds.x[index]
+        py = seeds.y[index]
+        new_seeds_number = len(index)
 
-        seeds_number = len(seeds)
-        new_seeds_number = int(seeds_number * times)
-
-        shuffled_seeds = list(seeds)
-        np.random.shuffle(shuffled_seeds)
-        px = multiply_list([s.x for s in shuffled_seeds], times)
-        py = multiply_list([s.y for s in shuffled_seeds], times)
-
-        random_angle = np.random.random(new_seeds_number) * 2 * math.pi
-        random_radius = np.random.random(new_seeds_number) * (max_random_radius - min_random_radius) + min_random_radius
+        random_angle = generator.uniform(0, 2 * math.pi, new_seeds_number)
+        random_radius = generator.uniform(min_random_radius, max_random_radius, new_seeds_number)
 
         rpx = px + random_radius * np.cos(random_angle)
         rpy = py + random_radius * np.sin(random_angle)
 
-        return [Seed(x, y, 'rand') for x, y in zip(rpx, rpy)]
+        return SeedBatch(rpx, rpy, 'rand')
 
     def find_seeds_from_border_or_content(self, image, foreground_mask, segments, mode):
         """
@@ -114,6 +93,7 @@ class Seeder(object):
         @param segment: array with segments marked
         @type segments: np.ndarray
         @param mode: 'border' or 'content' determining if look for maxima or minima
+        @rtype: SeedBatch
         """
 
         im_name = ''
@@ -124,6 +104,7 @@ class Seeder(object):
                    * self.parameters["segmentation"]["avgCellDiameter"]
             im_name = 'border' + im_name
             image = set_image_border(image, 1)
+            self.images.modified()
             excl_value = 1
         else:
             blur = self.parameters["segmentation"]["seeding"]["ContentBlur"] \
@@ -139,7 +120,8 @@ class Seeder(object):
 
         origin = im_name + origin
 
-        blurred = self.images.get_blurred(image, blur, cache_result=not excluding)
+        # seeding images are blurred once (exclusion images change every step)
+        blurred = self.images.get_blurred(image, blur, cache=False)
 
         if mode == 'border':
             blurred = 1 - blurred
@@ -147,23 +129,28 @@ class Seeder(object):
         maxima = find_maxima(blurred) * foreground_mask
 
         maxima_coords = np.nonzero(maxima)
-        seeds = zip(maxima_coords[1], maxima_coords[0])
-
-        seed_points = point_list_as_seeds(seeds, origin)
-        seed_points = self.cluster_seeds(seed_points)
+        seeds = SeedBatch(maxima_coords[1], maxima_coords[0], origin)
 
-        return seed_points
+        return self.cluster_seeds(seeds)
 
     def find_seeds_from_snakes(self, snakes):
         """
         Finds seeds from snakes centroids
         @param snakes: Grown snakes from previous frame
         @type snakes: list[Snake]
+        @rtype: SeedBatch
         """
-        return point_list_as_seeds([snake.centroid for snake in snakes], 'snake centroid')
+        return SeedBatch.from_points([snake.centroid for snake in snakes], 'snake centroid')
 
     def find_seeds(self, snakes, all_seeds, exclude_current_segments):
-        seeds = []
+        """
+        Finds new seeds for the current segmentation step.
+        @type snakes: list[Snake]
+        @param all_seeds: already processed seeds
+        @type all_seeds: SeedBatch
+        @rtype: SeedBatch
+        """
+        seeds = SeedBatch.empty()
 
         # First iteration of segmentation.
         if not exclude_current_segments:
@@ -173,7 +160,8 @@ class Seeder(object):
                 new_seeds += self.rand_seeds(
                     self.random_radius,
                     self.parameters["segmentation"]["seeding"]["from"]["cellBorderRandom"],
-                    new_seeds
+                    new_seeds,
+                    self.random_generator
                 )
 
             seeds += new_seeds
@@ -184,7 +172,8 @@ class Seeder(object):
                 new_seeds += self.rand_seeds(
                     self.random_radius,
                     self.parameters["segmentation"]["seeding"]["from"]["cellContentRandom"],
-                    new_seeds
+                    new_seeds,
+                    self.random_generator
                 )
 
                 seeds += new_seeds
@@ -196,7 +185,8 @@ class Seeder(object):
                 new_seeds += self.rand_seeds(
                     self.random_radius,
                     self.parameters["segmentation"]["seeding"]["from"]["cellBorderRemovingCurrSegmentsRandom"],
-                    new_seeds
+                    new_seeds,
+                    self.random_generator
                 )
 
                 seeds += new_seeds
@@ -207,7 +197,8 @@ class Seeder(object):
                 new_seeds += self.rand_seeds(
                     self.random_radius,
                     self.parameters["segmentation"]["seeding"]["from"]["cellContentRemovingCurrSegmentsRandom"],
-                    new_seeds
+                    new_seeds,
+                    self.random_generator
                 )
 
                 seeds += new_seeds
@@ -218,7 +209,8 @@ class Seeder(object):
                 new_seeds += self.rand_seeds(
                     self.random_radius,
                     self.parameters["segmentation"]["seeding"]["from"]["snakesCentroidsRandom"],
-                    new_seeds
+                    new_seeds,
+                    self.random_generator
                 )
                 seeds += new_seeds
 
@@ -230,91 +222,102 @@ class Seeder(object):
         """
         Ignore seeds that are close image borders or already processed seeds.
         @param image_shape: (y,x) image size
-        @type seeds: [cellstar.core.seed.Seed]
-        @type all_seeds: [cellstar.core.seed.Seed]
-        @return:
+        @type seeds: SeedBatch
+        @type all_seeds: SeedBatch
+        @return: seeds which are inside image and not closer than stars step to already processed or preceding seeds
+        @rtype: SeedBatch
         """
         distance = self.parameters["segmentation"]["stars"]["step"] * self.parameters["segmentation"]["avgCellDiameter"]
         distance = float(max(distance, 0.5))  # not less than half of pixel length
-        ok_seeds = np.array([False for _ in seeds])
-
-        grid_size = int(round(max(image_shape) * 1.1 / distance))
         im_y, im_x = image_shape
 
-        # Create grid
-        seeds_grid = SeedGrid(grid_size)
-
-        # Fill grid with previous seeds
-        for seed in all_seeds:
-            x = int(round(seed.x / distance))
-            y = int(round(seed.y / distance))
-            for xx in [x - 1, x, x + 1]:
-                for yy in [y - 1, y, y + 1]:
-                    seeds_grid.add_seed(xx, yy, seed)
-
-        # Fill grid with current seeds
-        for i in range(len(seeds)):
-            seed = seeds[i]
-            x = max(0, int(round(seed.x / distance)))
-            y = max(0, int(round(seed.y / distance)))
-
-            # Validate seed if it lies inside grid
-            if seeds_grid.inside(x, y):
-                ok_seeds[i] = seed_is_new(seed, seeds_grid.get(x, y), distance)
-
-            for xx in [x - 1, x, x + 1]:
-                for yy in [y - 1, y, y + 1]:
-                    seeds_grid.add_seed(xx, yy, seed)
+        xys = seeds.xy
+        ok_seeds = points_are_new(xys, all_seeds.xy, distance)
 
         # Remove seeds in image borders
-        seeds_x_ok = np.array([im_x - 0.5 > seed.x > 0.5 for seed in seeds])
-        seeds_y_ok = np.array([im_y - 0.5 > seed.y > 0.5 for seed in seeds])
-
-        # Filtered seeds boolean vector
-        ok_seeds = np.logical_and(ok_seeds, np.logical_and(seeds_y_ok, seeds_x_ok))
-
-        return [seeds[i] for i in range(len(seeds)) if ok_seeds[i]]
-
+        ok_seeds &= (xys[:, 0] > 0.5) & (xys[:, 0] < im_x - 0.5)
+        ok_seeds &= (xys[:, 1] > 0.5) & (xys[:, 1] < im_y - 0.5)
 
-def seed_is_new(seed, current_seeds, distance):
-    return all([euclidean_norm(seed.as_xy(), cs.as_xy()) >= distance for cs in current_seeds])
+        return seeds.select(ok_seeds)
 
 
-def point_list_as_seeds(pointsYX, origin):
-    return [Seed(point[0], point[1], origin) for point in pointsYX]
+def points_distances(xys1, xys2):
+    d = xys1 - xys2
+    return np.sqrt(d[:, 0] ** 2 + d[:, 1] ** 2)
 
 
-class SeedGrid(object):
-    def __init__(self, size=10):
-        self._size_x = size
-        self._size_y = size
-        self._grid = []
-        self._init_grid()
-
-    def _init_grid(self):
-        self._grid = np.empty((self._size_x, self._size_y), dtype=np.object)
-        self._grid.fill([])
-
-    def _resize(self, to_x, to_y):
-        self._size_y = max(self._size_y, to_y)
-        self._size_x = max(self._size_x, to_x)
+def points_are_new(xys, previous_xys, distance):
+    """
+    Determines which points are not closer than distance to any of the previous points
+    or to any of the points preceding it.
+    @param xys: (n x 2) array of points coordinates
+    @type xys: np.ndarray
+    @param previous_xys: (m x 2) array of already processed points coordinates
+    @type previous_xys: np.ndarray
+    @return: boolean vector of new points
+    @rtype: np.ndarray
+    """
+    new = np.ones(len(xys), dtype=bool)
+    if len(xys) == 0:
+        return new
 
-        self._grid = np.resize(self._grid, (self._size_x, self._size_y))
+    # slightly larger radius so that no pair is lost by rounding, exact distance is checked below
+    radius = distance * (1 + 1e-9)
+    tree = cKDTree(xys)
 
-    def get(self, x, y):
-        return self._grid[x][y]
+    pairs = tree.query_pairs(radius, output_type='ndarray')
+    if len(pairs) > 0:
+        close = points_distances(xys[pairs[:, 0]], xys[pairs[:, 1]]) < distance
+        new[pairs[close, 1]] = False
 
-    def size(self):
-        return self._size_x, self._size_y
+    if len(previous_xys) > 0:
+        pairs = tree.sparse_distance_matrix(cKDTree(previous_xys), radius, output_type='ndarray')
+        if len(pairs) > 0:
+            close = points_distances(xys[pairs['i']], previous_xys[pairs['j']]) < distance
+            new[pairs['i'][close]] = False
 
-    def add_seed(self, x, y, seed):
-        if x < 0 or y < 0:
-            return
+    return new
 
-        if x >= self._size_x or y >= self._size_y:
-            self._resize(x + 1, y + 1)
 
-        self._grid[x][y] = self._grid[x][y] + [seed]
+def mutual_nearest_pairs(points, max_distance2):
+    """
+    Finds pairs of points which are nearest to each other and whose squared distance is less than max_distance2.
+    Only points closer than the limit are compared, which are found using kd-tree, so the nearest neighbour
+    is determined exactly as in the full distance matrix (equally distant neighbours are resolved by the lower index).
+    @param points: (n x 2) array of points coordinates
+    @type points: np.ndarray
+    @param max_distance2: exclusive limit on squared distance between points of a pair
+    @return: indices of the first and the second point of every pair, first indices are increasing and lower than second
+    @rtype: (np.ndarray, np.ndarray)
+    """
+    empty = np.zeros(0, dtype=int)
+    if len(points) < 2 or max_distance2 <= 0:
+        return empty, empty
+
+    # slightly larger radius so that no pair is lost by rounding, exact limit is checked below
+    radius = math.sqrt(max_distance2) * (1 + 1e-9)
+    pairs = cKDTree(points).query_pairs(radius, output_type='ndarray')
+    if len(pairs) == 0:
+        return empty, empty
+
+    first, second = pairs[:, 0], pairs[:, 1]
+    d = points[first] - points[second]
+    d2 = np.sum(d * d, 1)
+    close = d2 < max_distance2
+    first, second, d2 = first[close], second[close], d2[close]
+
+    # nearest neighbour of every point which has any neighbour closer than limit
+    source = np.concatenate((first, second))
+    target = np.concatenate((second, first))
+    order = np.lexsort((target, np.concatenate((d2, d2)), source))
+    source, target = source[order], target[order]
+    is_first = np.ones(len(source), dtype=bool)
+    is_first[1:] = source[1:] != source[:-1]
+    nearest = np.full(len(points), -1, dtype=int)
+    nearest[source[is_first]] = target[is_first]
+
+    p1 = np.flatnonzero(nearest >= 0)
+    p2 = nearest[p1]
+    good = np.logical_and(nearest[p2] == p1, p1 < p2)
+    return p1[good], p2[good]
 
-    def inside(self, x, y):
-        return x < self._size_x and y < self._size_y
@@ -9,10 +9,14 @@ import math
 
 import numpy as np
 
+from cellstar.core.batch_grow import BatchGrower
 from cellstar.core.point import Point
+from cellstar.core.polar_transform import StarPatch
 from cellstar.utils import calc_util, image_util
 from cellstar.utils.debug_util import *
-from cellstar.utils.index import Index
+
+# masks used in snake evaluation, reused between snakes evaluated in the same thread
+evaluation_buffers = calc_util.ScratchBuffers()
 
 
 class Snake(object):
@@ -91,88 +95,25 @@ class Snake(object):
         @type polar_transform: cellstar.core.vectorized.polar_transform.PolarTransform
         @type size_weight: float
         """
+        BatchGrower(self.images, self.parameters, polar_transform).grow([self], size_weight)
 
-        #
-        # Initialization
-        #
-
+    def grow_from_smoothed_radius(self, best_radius, smoothed_radius, radius_bounds, polar_transform):
+        """
+        Determine the snake contour from the already smoothed best radii (see calc_util.smooth_contours).
+        @param best_radius: radius with the best quality for every angle
+        @type best_radius: np.ndarray
+        @param smoothed_radius: smoothed radius for every angle
+        @type smoothed_radius: np.ndarray
+        @param radius_bounds: radius bounds used in smoothing
+        @type radius_bounds: np.ndarray
+        @type polar_transform: cellstar.core.vectorized.polar_transform.PolarTransform
+        """
         self.centroid_x = self.seed.x
         self.centroid_y = self.seed.y
 
         points_number = polar_transform.N
-        step = polar_transform.step
         unstick = self.parameters["segmentation"]["stars"]["unstick"]
-        avg_cell_diameter = self.parameters["segmentation"]["avgCellDiameter"]
-        smoothness = self.parameters["segmentation"]["stars"]["smoothness"]
-        gradient_weight = self.parameters["segmentation"]["stars"]["gradientWeight"]
-        brightness_weight = self.parameters["segmentation"]["stars"]["brightnessWeight"]
-        size_weight = float(size_weight) / avg_cell_diameter
-        cum_brightness_weight = self.parameters["segmentation"]["stars"]["cumBrightnessWeight"] / avg_cell_diameter
-        background_weight = self.parameters["segmentation"]["stars"]["backgroundWeight"] / avg_cell_diameter
-        border_thickness_steps = \
-            1 + math.floor(float(self.parameters["segmentation"]["stars"]["borderThickness"]) / float(step))
-
-        im = self.images.image_back_difference_blurred
-        imb = self.images.brighter
-        imfg = self.images.foreground_mask
-
-        steps = polar_transform.steps
         max_r = polar_transform.max_r
-        R = polar_transform.R.flat
-        t = polar_transform.t
-        max_diff = (abs(smoothness) * np.arange(1, steps + 1) / points_number + 0.5).astype(int)
-
-        px = float(self.centroid_x) + polar_transform.x
-        px = np.maximum(px, 0)
-        px = np.minimum(px, im.shape[1] - 1)
-
-        py = float(self.centroid_y) + polar_transform.y
-        py = np.maximum(py, 0)
-        py = np.minimum(py, im.shape[0] - 1)
-
-        #
-        # Contour quality function calculation and finding the best candidates.
-        #
-        #
-        # index is ordered first by angle then by radius
-        # for angle:
-        #   for radius:
-
-        index = Index.create(px.round(), py.round()).reshape(
-            (polar_transform.x.shape[0], polar_transform.x.shape[1], 2))
-
-        #
-        #  pre_f - part of function quality for interior
-        #  f_tot - final quality array
-        #
-
-        numpy_index = Index.to_numpy(index)
-        pre_f = (cum_brightness_weight * imb[numpy_index] \
-                 + background_weight * (1 - imfg[numpy_index])) * step
-        f = np.cumsum(pre_f, axis=0)
-
-        im_diff = calc_util.get_gradient(im, index, border_thickness_steps)
-
-        f_tot = f \
-                - size_weight * np.kron(np.log(R), np.ones((t.size, 1))).T \
-                - gradient_weight * im_diff \
-                - brightness_weight * im[numpy_index]
-
-        f_tot = f_tot.T
-        # f_tot = image_util.image_smooth(f_tot, 1)
-
-        # Scale entire array to 0-1 then scale individual angles.
-        f_tot = (f_tot - f_tot.min()) / (f_tot.max() - f_tot.min() + self.epsilon)
-        f_tot /= (np.kron(np.ones((f_tot.shape[1], 1)), f_tot.max(axis=1)).T + self.epsilon)
-
-        # Find initial contour
-        _, best_radius = np.where(f_tot == np.kron(np.ones((f_tot.shape[1], 1)), f_tot.min(axis=1)).T)
-
-        #
-        # Contour smoothing
-        #
-
-        smoothed_radius, radius_bounds = self.smooth_contour(best_radius, max_diff, points_number, f_tot)
 
         self.original_edgepoints = (smoothed_radius != radius_bounds) | \
                                    ((smoothed_radius == best_radius) & (smoothed_radius < max_r - 2))
@@ -192,66 +133,17 @@ class Snake(object):
         final_radius = np.minimum(np.maximum(smoothed_radius, 1), max_r - 1)
         #final_radius = np.minimum(np.maximum(np.round(smoothed_radius + 1), 1), max_r - 1)
 
-        px = self.seed.x + step * final_radius * np.cos(t.T)
-        py = self.seed.y + step * final_radius * np.sin(t.T)
-
         self.polar_coordinate_boundary = final_radius
-        self.points = [Point(x, y) for x, y in zip(px, py)]
+        self.set_points_from_boundary(polar_transform)
 
-    def smooth_contour(self, radius, max_diff, points_number, f_tot):
+    def set_points_from_boundary(self, polar_transform):
         """
-        Smoothing contour using greedy length cut. Rotating from min radius clockwise and anti.
-        @type radius: np.ndarray
-        @param max_diff: max change of ray length per iter.
-        @type max_diff np.ndarray
-        @type points_number int
-        @param f_tot: quality function array
-        @type f_tot: np.ndarray
-
-        @rtype (np.ndarray, np.ndarray)
-        @return (smoothed_radius, used_radius_bounds)
+        Create contour points list from polar_coordinate_boundary.
+        @type polar_transform: cellstar.core.vectorized.polar_transform.PolarTransform
         """
-        min_angle = radius.argmin()
-        istart = min_angle
-
-        xmins2 = np.copy(radius)
-        xmaxs = np.copy(radius)
-
-        changed = True
-
-        def cut_rotate(start, step):
-            last_ok = False
-            iteration = 0
-            any_cut = False
-            while not (iteration >= points_number and last_ok):
-                current = (start + iteration * step) % points_number
-                previous = (current - 1 * step) % points_number
-
-                if xmins2[current] - xmins2[previous] > max_diff[xmins2[previous]]:
-                    xmaxs[current] = xmins2[previous] + max_diff[xmins2[previous]]
-                    f_tot_slice = f_tot[current, :xmaxs[current] + 1]
-                    xmins2[current] = f_tot_slice.argmin()
-                    if step < 0:
-                        xmins2[current] = max(xmins2[current], xmins2[previous] - max_diff[xmins2[previous]])
-                    last_ok = False
-                    any_cut = True
-                else:
-                    last_ok = True
-
-                iteration += 1
-            return (start + iteration * step) % points_number, any_cut
-
-        current_position = istart
-        while changed:
-            changed = False
-
-            current_position, any_cut = cut_rotate(current_position, 1)
-            changed = changed or any_cut
-
-            current_position, any_cut = cut_rotate(current_position, -1)
-            changed = changed or any_cut
-
-        return xmins2, xmaxs
+        px, py = calc_util.polar_to_cartesian(self.polar_coordinate_boundary, self.seed.x, self.seed.y,
+                                              polar_transform)
+        self.points = [Point(x, y) for x, y in zip(px, py)]
 
     def evaluate(self, polar_transform):
         """
@@ -270,20 +162,55 @@ class Snake(object):
         max_border_r = 0.1 * avg_cell_diameter
         ranking_params = self.parameters["segmentation"]["ranking"]
 
-        image_bounds = calc_util.get_cartesian_bounds(self.polar_coordinate_boundary, self.seed.x, self.seed.y,
-                                                      polar_transform)
-        dilated_bounds = image_util.extend_slices(image_bounds, int(max_border_r * 2))
+        # All masks are local to the dilated bounds of the snake and use buffers reused between snakes.
+        if self.parameters["segmentation"]["processing"]["rasterizer"] == "polar":
+            # Border rings depend on the area of the segment, so the segment is rasterized together with
+            # the rings of every dilation which its border radius can give.
+            dilations = np.arange(round(min_border_r / polar_transform.step),
+                                  round(max_border_r / polar_transform.step) + 1)
+            max_radius = min(np.max(self.polar_coordinate_boundary) + dilations[-1], len(polar_transform.R) - 1)
+            patch = StarPatch(polar_transform, self.seed.x, self.seed.y, max_radius, self.images.image.shape,
+                              evaluation_buffers)
+            dilated_bounds = patch.slices
+
+            boundaries = np.vstack([self.polar_coordinate_boundary,
+                                    np.minimum(self.polar_coordinate_boundary + dilations[:, np.newaxis],
+                                               len(polar_transform.R) - 1),
+                                    np.maximum(self.polar_coordinate_boundary - dilations[:, np.newaxis], 1)])
+            masks = patch.masks(boundaries, out=evaluation_buffers.get("star_masks", (len(boundaries),) + patch.shape))
+
+            def border_masks(dilation):
+                index = dilation - dilations[0]
+                return masks[1 + index], masks[1 + len(dilations) + index]
+
+            segment = masks[0]
+            in_polygon, in_polygon_local_yx = calc_util.crop_to_content(segment)
+            self.in_polygon = in_polygon.copy()
+        else:
+            image_bounds = calc_util.get_cartesian_bounds(self.polar_coordinate_boundary, self.seed.x, self.seed.y,
+                                                          polar_transform)
+            dilated_bounds = image_util.extend_slices(image_bounds, int(max_border_r * 2))
+            origin_in_slice = calc_util.inslice_point((self.seed.y, self.seed.x), dilated_bounds)
+            origin_in_slice = Point(x=origin_in_slice[1], y=origin_in_slice[0])
+            local_shape = self.images.image[dilated_bounds].shape
+
+            def star_mask(boundary, name):
+                return calc_util.star_in_polygon(local_shape, boundary, origin_in_slice.x, origin_in_slice.y,
+                                                 polar_transform, out=evaluation_buffers.get(name, local_shape))[0]
+
+            def border_masks(dilation):
+                dilated_boundary = np.minimum(self.polar_coordinate_boundary + dilation, len(polar_transform.R) - 1)
+                eroded_boundary = np.maximum(self.polar_coordinate_boundary - dilation, 1)
+                return star_mask(dilated_boundary, "dilated"), star_mask(eroded_boundary, "eroded")
+
+            segment, self.in_polygon, in_polygon_local_yx = \
+                calc_util.star_in_polygon(local_shape, self.polar_coordinate_boundary,
+                                          origin_in_slice.x, origin_in_slice.y, polar_transform,
+                                          out=evaluation_buffers.get("segment", local_shape))
 
         original_clean = self.images.image_back_difference[dilated_bounds]
         brighter = self.images.brighter[dilated_bounds]
         cell_content_mask = self.images.cell_content_mask[dilated_bounds]
-        origin_in_slice = calc_util.inslice_point((self.seed.y, self.seed.x), dilated_bounds)
-        origin_in_slice = Point(x=origin_in_slice[1], y=origin_in_slice[0])
-
-        segment, self.in_polygon, in_polygon_local_yx = calc_util.star_in_polygon(brighter.shape,
-                                                                                  self.polar_coordinate_boundary,
-                                                                                  origin_in_slice.x, origin_in_slice.y,
-                                                                                  polar_transform)
         self.in_polygon_yx = calc_util.unslice_point(in_polygon_local_yx, dilated_bounds)
 
         self.area = np.count_nonzero(self.in_polygon) + self.epsilon
@@ -291,18 +218,10 @@ class Snake(object):
         border_radius = max(min(approx_radius, max_border_r), min_border_r)
 
         dilation = round(border_radius / polar_transform.step)
+        dilated, eroded = border_masks(dilation)
 
-        dilated_boundary = np.minimum(self.polar_coordinate_boundary + dilation, len(polar_transform.R) - 1)
-        eroded_boundary = np.maximum(self.polar_coordinate_boundary - dilation, 1)
-
-        dilated, _, _ = calc_util.star_in_polygon(brighter.shape, dilated_boundary,
-                                                  origin_in_slice.x, origin_in_slice.y, polar_transform)
-
-        eroded, _, _ = calc_util.star_in_polygon(brighter.shape, eroded_boundary,
-                                                 origin_in_slice.x, origin_in_slice.y, polar_transform)
-
-        out_border = dilated ^ segment
-        in_border = segment ^ eroded
+        out_border = np.logical_xor(dilated, segment, out=dilated)
+        in_border = np.logical_xor(segment, eroded, out=eroded)
 
         out_border_area = np.count_nonzero(out_border) + self.epsilon
         in_border_area = np.count_nonzero(in_border) + self.epsilon
@@ -12,6 +12,9 @@ import numpy as np
 
 from cellstar.core.snake import Snake
 
+logger = logging.getLogger(__package__)
+log_message = "Discarding snake {0} for {1}: {2}"
+
 
 class SnakeFilter(object):
     """
@@ -26,6 +29,7 @@ class SnakeFilter(object):
         """
         self.parameters = parameters
         self.images = images
+        self.reset()
 
     def is_single_snake_discarded(self, snake):
         """
@@ -52,67 +56,200 @@ class SnakeFilter(object):
 
         return False
 
-    def filter(self, snakes):
+    def check_snake(self, snake_index, snake, local_segments):
+        """
+        Check snake against already accepted snakes and the constraints of single snake.
+        Area of the snake is changed to its vacant area if it does not overlap too much.
+        @param snake_index: index of the snake used in log
+        @type snake: Snake
+        @param local_segments: accepted snakes labels (or occupied pixels mask) in snake.in_polygon_slice
+        @return: vacant part of the snake if it is accepted (None otherwise) and its area overlapping accepted snakes
+        @rtype: (np.ndarray, int)
+        """
+        local_snake = snake.in_polygon
+
+        overlap_area = np.count_nonzero(np.logical_and(local_segments, local_snake))
+        overlap = float(overlap_area) / snake.area
+
+        if overlap > self.parameters["segmentation"]["maxOverlap"]:
+            logger.debug(log_message.format(snake_index, 'too much overlapping', overlap))
+            return None, overlap_area
+
+        vacant_snake = np.logical_and(local_snake, local_segments == 0)
+        vacant_cell_content = vacant_snake[self.images.cell_content_mask[snake.in_polygon_slice]]
+        snake.area = np.count_nonzero(vacant_snake) + Snake.epsilon
+        avg_inner_darkness = float(np.count_nonzero(vacant_cell_content)) / float(snake.area)
+        if avg_inner_darkness < self.parameters["segmentation"]["minAvgInnerDarkness"]:
+            logger.debug(log_message.format(snake_index, 'too low inner darkness', '...'))
+            return None, overlap_area
+
+        if snake.area > (self.parameters["segmentation"]["maxArea"] * self.parameters["segmentation"]["avgCellDiameter"]**2 * math.pi / 4):
+            logger.debug(log_message.format(snake_index, 'too big area', str(snake.area)))
+            return None, overlap_area
+
+        if snake.area < (self.parameters["segmentation"]["minArea"] * self.parameters["segmentation"]["avgCellDiameter"]**2 * math.pi / 4):
+            logger.debug(log_message.format(snake_index, 'too small area:', str(snake.area)))
+            return None, overlap_area
+
+        max_free_border = self.parameters["segmentation"]["stars"]["points"] * self.parameters["segmentation"]["maxFreeBorder"]
+        if snake.max_contiguous_free_border > max_free_border:
+            logger.debug(log_message.format(snake_index,
+                                            'too long contiguous free border',
+                                            str(snake.max_contiguous_free_border) +
+                                            ' over ' + str(max_free_border)))
+            return None, overlap_area
+
+        return vacant_snake, overlap_area
+
+    def filter(self, snakes, segments=None):
         """
         @type snakes: list[Snake]
+        @param segments: labels of already accepted snakes (-1 for masked pixels) of owner_type, which snakes
+        can overlap only up to maxOverlap, new snakes are labelled with the following numbers
+        @type segments: np.ndarray
         @rtype: list[Snake]
         """
         logging.basicConfig(format='%(asctime)-15s %(message)s', level=logging.DEBUG)
-        logger = logging.getLogger(__package__)
-        log_message = "Discarding snake {0} for {1}: {2}"
 
         original = self.images.image
         filtered_snakes = []
-        segments = np.zeros(original.shape, dtype=int)
+        current_accepted_snake_index = 1
+        if segments is None:
+            segments = np.zeros(original.shape, dtype=self.owner_type())
 
-        # do not allow cells on masked areas
-        segments[self.images.mask == 0] = -1
+            # do not allow cells on masked areas
+            segments[self.images.mask == 0] = -1
+        elif segments.size:
+            current_accepted_snake_index = int(max(0, segments.max())) + 1
 
         if len(snakes) > 0:
             snakes_sorted = sorted(enumerate(snakes), key=lambda x: x[1].rank)
-            current_accepted_snake_index = 1
-            for i in range(len(snakes_sorted)):
-                curr_snake = snakes_sorted[i][1]
-                snake_index = snakes_sorted[i][0]
-
+            for snake_index, curr_snake in snakes_sorted:
                 if curr_snake.rank >= Snake.max_rank:
                     logger.debug(log_message.format(snake_index, 'too high rank', curr_snake.rank))
                     break
 
-                local_snake = curr_snake.in_polygon
-                sxy = curr_snake.in_polygon_slice
-                local_segments = segments[sxy]
+                local_segments = segments[curr_snake.in_polygon_slice]
+                vacant_snake, _ = self.check_snake(snake_index, curr_snake, local_segments)
+                if vacant_snake is not None:
+                    local_segments[vacant_snake] = current_accepted_snake_index
+                    filtered_snakes.append(curr_snake)
+                    current_accepted_snake_index += 1
 
-                overlap_area = np.count_nonzero(np.logical_and(local_segments, local_snake))
-                overlap = float(overlap_area) / curr_snake.area
+        segments *= self.images.mask  # clear mask
+        self.images._segmentation = segments.astype(self.images.label_type(current_accepted_snake_index - 1),
+                                                    copy=False)
+        return filtered_snakes
 
-                if overlap > self.parameters["segmentation"]["maxOverlap"]:
-                    logger.debug(log_message.format(snake_index, 'too much overlapping', overlap))
-                else:
-                    vacant_snake = np.logical_and(local_snake, local_segments == 0)
-                    vacant_cell_content = vacant_snake[self.images.cell_content_mask[sxy]]
-                    curr_snake.area = np.count_nonzero(vacant_snake) + Snake.epsilon
-                    avg_inner_darkness = float(np.count_nonzero(vacant_cell_content)) / float(curr_snake.area)
-                    if avg_inner_darkness < self.parameters["segmentation"]["minAvgInnerDarkness"]:
-                        logger.debug(log_message.format(snake_index, 'too low inner darkness', '...'))
-                    else:
-                        if curr_snake.area > (self.parameters["segmentation"]["maxArea"] * self.parameters["segmentation"]["avgCellDiameter"]**2 * math.pi / 4):
-                            logger.debug(log_message.format(snake_index, 'too big area', str(curr_snake.area)))
-                        else:
-                            if curr_snake.area < (self.parameters["segmentation"]["minArea"] * self.parameters["segmentation"]["avgCellDiameter"]**2 * math.pi / 4):
-                                logger.debug(log_message.format(snake_index, 'too small area:', str(curr_snake.area)))
-                            else:
-                                max_free_border = self.parameters["segmentation"]["stars"]["points"] * self.parameters["segmentation"]["maxFreeBorder"]
-                                if curr_snake.max_contiguous_free_border > max_free_border:
-                                    logger.debug(log_message.format(snake_index,
-                                                                    'too long contiguous free border',
-                                                                    str(curr_snake.max_contiguous_free_border) +
-                                                                    ' over ' + str(max_free_border)))
-                                else:
-                                    local_segments[tuple([vacant_snake])] = current_accepted_snake_index
-                                    filtered_snakes.append(curr_snake)
-                                    current_accepted_snake_index += 1
+    def reset(self):
+        """
+        Clear the state of incremental filtering.
+        """
+        self.accepted = []
+        self.accepted_owners = []
+        self.accepted_overlaps = []
+        self.owners = None
+        self.next_owner = 1
 
+    def filter_incremental(self, snakes, new_snakes):
+        """
+        Filter snakes accepted in the previous call together with new snakes. Gives the same result as
+        filter(snakes + new_snakes) but keeps the owners of pixels and the accepted snakes between calls.
+        As long as no new snake is accepted before it, previously accepted snake sees the same accepted
+        snakes so only its overlap has to be checked again (with its area changed to vacant one).
+        When a new snake is accepted or previously accepted snake is discarded, the pixels of the following
+        previously accepted snakes are released and those snakes are fully checked again.
+        @param snakes: snakes accepted in the previous call, if they are different the state is rebuilt
+        @type snakes: list[Snake]
+        @param new_snakes: snakes to add
+        @type new_snakes: list[Snake]
+        @rtype: list[Snake]
+        """
+        if self.owners is None or len(snakes) != len(self.accepted) or \
+                any(snake is not accepted for snake, accepted in zip(snakes, self.accepted)):
+            self.reset()
+            self.owners = np.zeros(self.images.image.shape, dtype=self.owner_type())
+            # do not allow cells on masked areas
+            self.owners[self.images.mask == 0] = -1
+            previous_number = 0
+        else:
+            previous_number = len(snakes)
+
+        all_snakes = list(snakes) + list(new_snakes)
+        previous_owners = self.accepted_owners
+        previous_overlaps = self.accepted_overlaps
+        accepted, accepted_owners, accepted_overlaps = [], [], []
+
+        # position in which the owner of pixels was accepted in this call, pixels of previously accepted snakes
+        # which are not yet confirmed (not yet processed) are treated as vacant
+        unprocessed = len(all_snakes) + 1
+        owner_positions = np.full(self.next_owner + len(all_snakes) + 1, unprocessed, dtype=int)
+        owner_positions[-1] = -1  # masked pixels are always occupied
+
+        snakes_sorted = sorted(enumerate(all_snakes), key=lambda x: x[1].rank)
+        diverged = False
+        for position, (snake_index, curr_snake) in enumerate(snakes_sorted):
+            if curr_snake.rank >= Snake.max_rank:
+                logger.debug(log_message.format(snake_index, 'too high rank', curr_snake.rank))
+                break
+
+            if snake_index < previous_number and not diverged:
+                owner = previous_owners[snake_index]
+                overlap_area = previous_overlaps[snake_index]
+                overlap = float(overlap_area) / curr_snake.area
+                if overlap <= self.parameters["segmentation"]["maxOverlap"]:
+                    owner_positions[owner] = position
+                    accepted.append(curr_snake)
+                    accepted_owners.append(owner)
+                    accepted_overlaps.append(overlap_area)
+                    continue
+
+                logger.debug(log_message.format(snake_index, 'too much overlapping', overlap))
+                self.release_pixels(curr_snake, owner)
+                self.release_following(snakes_sorted[position + 1:], previous_number, previous_owners)
+                diverged = True
+                continue
+
+            local_owners = self.owners[curr_snake.in_polygon_slice]
+            occupied = owner_positions[local_owners] < position
+            vacant_snake, overlap_area = self.check_snake(snake_index, curr_snake, occupied)
+            if vacant_snake is not None:
+                if not diverged:
+                    self.release_following(snakes_sorted[position + 1:], previous_number, previous_owners)
+                    diverged = True
+                local_owners[vacant_snake] = self.next_owner
+                owner_positions[self.next_owner] = position
+                accepted.append(curr_snake)
+                accepted_owners.append(self.next_owner)
+                accepted_overlaps.append(overlap_area)
+                self.next_owner += 1
+
+        self.accepted = accepted
+        self.accepted_owners = accepted_owners
+        self.accepted_overlaps = accepted_overlaps
+
+        # label accepted snakes with consecutive numbers in order of acceptance
+        labels = np.zeros(self.next_owner, dtype=self.images.label_type(len(accepted)))
+        labels[accepted_owners] = np.arange(1, len(accepted) + 1)
+        segments = labels[np.maximum(self.owners, 0)]
         segments *= self.images.mask  # clear mask
         self.images._segmentation = segments
-        return filtered_snakes
+        return list(accepted)
+
+    def owner_type(self):
+        """
+        @return: type of images with owners of pixels (-1 for masked pixels)
+        """
+        return int if self.images.float_type == float else np.int32
+
+    def release_pixels(self, snake, owner):
+        local_owners = self.owners[snake.in_polygon_slice]
+        local_owners[local_owners == owner] = 0
+
+    def release_following(self, following_sorted, previous_number, previous_owners):
+        """
+        Release pixels of previously accepted snakes which follow the point where the result diverged.
+        """
+        for snake_index, snake in following_sorted:
+            if snake_index < previous_number:
+                self.release_pixels(snake, previous_owners[snake_index])
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Tiling splits frames too big to be segmented at once into tiles with halo and stitches snakes of the tiles.
+Every tile has a core, cores of tiles cover the frame without overlapping. Tile is segmented with the halo around
+its core so that snakes of cells in the core are not cut, then only snakes with centroid in the core are kept.
+Background of the frame is calculated tile by tile too (see TiledBackground).
+Date: 2013-2016
+Website: http://cellstar-algorithm.org/
+"""
+
+import math
+import threading
+
+import numpy as np
+
+from cellstar.core.image_repo import ImageRepo
+from cellstar.core.point import Point
+from cellstar.core.seed import Seed
+from cellstar.utils.image_util import image_downsample, image_upsample
+
+# number of bins of histograms from which median of the frame is calculated
+MEDIAN_BINS = 2 ** 16
+
+
+class Tile(object):
+    """
+    @ivar core: slices of the core of the tile in the frame
+    @ivar slices: slices of the tile (core with halo) in the frame
+    @ivar core_local: slices of the core in the tile
+    @ivar offset: position [y, x] of the tile in the frame
+    """
+
+    def __init__(self, core, halo, shape):
+        """
+        @param core: slices of the core in the frame
+        @param halo: width of the halo around the core
+        @param shape: shape of the frame
+        """
+        self.core = core
+        self.slices = extend(core, halo, shape)
+        self.offset = [s.start for s in self.slices]
+        self.core_local = tuple(slice(c.start - s.start, c.stop - s.start) for c, s in zip(core, self.slices))
+
+    def __repr__(self):
+        return "Tile(y={0.start}:{0.stop},x={1.start}:{1.stop})".format(*self.core)
+
+
+def extend(slices, halo, shape):
+    """
+    @return: slices extended by halo on every side and cut to the shape
+    """
+    return tuple(slice(max(0, s.start - halo), min(size, s.stop + halo)) for s, size in zip(slices, shape))
+
+
+def tile_halo(parameters):
+    """
+    @return: width of the halo which fits the biggest snake
+    @rtype: int
+    """
+    return int(math.ceil(parameters["segmentation"]["stars"]["maxSize"] * parameters["segmentation"]["avgCellDiameter"]))
+
+
+def split_tiles(shape, tile_size, halo):
+    """
+    @param shape: shape of the frame
+    @param tile_size: size of the core of tiles
+    @param halo: width of the halo around cores
+    @rtype: list[Tile]
+    """
+    return [Tile((slice(y, min(y + tile_size, shape[0])), slice(x, min(x + tile_size, shape[1]))), halo, shape)
+            for y in range(0, shape[0], tile_size) for x in range(0, shape[1], tile_size)]
+
+
+def in_core(snake, tile):
+    """
+    @param snake: snake of the tile
+    @type snake: cellstar.core.snake.Snake
+    @type tile: Tile
+    @return: True if centroid of the snake is in the core of the tile
+    """
+    y, x = int(math.floor(snake.centroid_y)), int(math.floor(snake.centroid_x))
+    return tile.core_local[0].start <= y < tile.core_local[0].stop and \
+        tile.core_local[1].start <= x < tile.core_local[1].stop
+
+
+def move_snake(snake, tile, images):
+    """
+    Moves snake of the tile to the frame.
+    @type snake: cellstar.core.snake.Snake
+    @type tile: Tile
+    @param images: image repository of the frame
+    @type images: cellstar.core.image_repo.ImageRepo
+    @rtype: cellstar.core.snake.Snake
+    """
+    dy, dx = tile.offset
+    snake.seed = Seed(snake.seed.x + dx, snake.seed.y + dy, snake.seed.origin)
+    snake.points = [Point(p.x + dx, p.y + dy) for p in snake.points]
+    snake.in_polygon_yx = [snake.in_polygon_yx[0] + dy, snake.in_polygon_yx[1] + dx]
+    snake.centroid_x += dx
+    snake.centroid_y += dy
+    snake.images = images
+    return snake
+
+
+def snake_boxes(snakes):
+    """
+    @return: bounding boxes [y1, y2, x1, x2] of snakes
+    @rtype: np.ndarray
+    """
+    return np.array([[bound for s in snake.in_polygon_slice for bound in (s.start, s.stop)] for snake in snakes],
+                    dtype=int).reshape(-1, 4)
+
+
+def stitch_snakes(tiles, tiles_snakes, snake_filter):
+    """
+    Joins snakes of tiles moved to the frame. Snakes inside the core of their tile were already filtered against
+    all snakes which can overlap them except boundary candidates of other tiles, which cross the borders of their
+    cores. Boundary candidates are filtered again together with the snakes they can overlap, while pixels of the
+    other snakes are occupied. Labels of the frame are set in the image repository of the filter.
+    @type tiles: list[Tile]
+    @param tiles_snakes: snakes of every tile with centroid in its core
+    @type tiles_snakes: list[list[cellstar.core.snake.Snake]]
+    @param snake_filter: filter of the frame
+    @type snake_filter: cellstar.core.snake_filter.SnakeFilter
+    @return: snakes of the frame in order of their labels
+    @rtype: list[cellstar.core.snake.Snake]
+    """
+    interior, candidates = [], []
+    for tile, snakes in zip(tiles, tiles_snakes):
+        for snake in snakes:
+            inside = all(c.start <= s.start and s.stop <= c.stop for s, c in zip(snake.in_polygon_slice, tile.core))
+            (interior if inside else candidates).append(snake)
+
+    candidate_boxes = snake_boxes(candidates)
+    fixed, contested = [], []
+    for snake, (y1, y2, x1, x2) in zip(interior, snake_boxes(interior)):
+        overlapping = (candidate_boxes[:, 0] < y2) & (candidate_boxes[:, 1] > y1) & \
+                      (candidate_boxes[:, 2] < x2) & (candidate_boxes[:, 3] > x1)
+        (contested if overlapping.any() else fixed).append(snake)
+
+    images = snake_filter.images
+    segments = np.zeros(images.image.shape, dtype=snake_filter.owner_type())
+    segments[images.mask == 0] = -1
+    fixed.sort(key=lambda snake: snake.rank)
+    for label, snake in enumerate(fixed, 1):
+        local_segments = segments[snake.in_polygon_slice]
+        local_segments[snake.in_polygon & (local_segments == 0)] = label
+
+    return fixed + snake_filter.filter(candidates + contested, segments)
+
+
+def histogram_median(counts, sums):
+    """
+    @param counts: numbers of values in bins of histogram
+    @param sums: sums of values in bins
+    @return: median of the values, exact if every bin holds only one distinct value
+    """
+    cumulative = np.cumsum(counts)
+
+    def value(index):
+        bin_index = np.searchsorted(cumulative, index + 1)
+        return sums[bin_index] / counts[bin_index]
+
+    number = cumulative[-1]
+    return (value((number - 1) // 2) + value(number // 2)) / 2.0
+
+
+class TiledBackground(object):
+    """
+    Background of a frame calculated tile by tile like ImageRepo.calculate_background with the method set in
+    processing background. Background mask is calculated in tiles with halo using normalization range of
+    the whole frame, median of the background pixels comes from histograms accumulated over tiles. Background
+    of a core is calculated in the core extended by the sum of all blurring radiuses. With the pyramid method
+    the large radius steps run on its blocks of ImageRepo.pyramid_factor, which are aligned with the blocks of
+    the frame, the small ones in full resolution. Apart from the background itself only the background mask
+    of the frame is kept, so memory of the intermediate images depends on the size of tiles.
+    """
+
+    def __init__(self, image, mask, parameters):
+        """
+        @param image: image of the frame
+        @param mask: mask of the frame (pixels which are not ignored) or None
+        @type parameters: dict
+        """
+        self.image = image
+        self.mask = mask
+        self.parameters = parameters
+        images = ImageRepo(image[:0, :0], parameters)
+        self.float_type = images.float_type
+        self.radiuses = images.background_smooth_radiuses()
+        self.factor, self.coarse_steps = 1, 0
+        if parameters["segmentation"]["processing"]["background"] == "pyramid":
+            self.factor, self.coarse_steps = ImageRepo.pyramid_factor(self.radiuses)
+        # width of the part influencing the background in the full resolution steps
+        self.spread_halo = int(math.ceil(sum(self.radiuses[self.coarse_steps:])))
+        # width of the part influencing the background in the downsampled steps
+        self.coarse_halo = int(math.ceil(sum(self.radiuses[:self.coarse_steps])))
+        # width of the part influencing the background mask
+        self.mask_halo = int(parameters["segmentation"]["background"]["computeByBlurring"]
+                             * parameters["segmentation"]["avgCellDiameter"]) + tile_halo(parameters)
+
+        self.background_mask = None
+        self.filler_value = None
+        self.histograms = None
+        self.lock = threading.Lock()
+
+    def window(self, slices, halo, factor=1):
+        """
+        @param factor: the window starts and ends at multiples of factor (or at the end of the frame)
+        @return: image repository of the part of the frame extended by halo, the slices in it and its slices
+        @rtype: (ImageRepo, tuple, tuple)
+        """
+        window_slices = tuple(slice(s.start // factor * factor, min(size, -(-s.stop // factor) * factor))
+                              for s, size in zip(extend(slices, halo, self.image.shape), self.image.shape))
+        window = ImageRepo(self.image[window_slices], self.parameters)
+        if self.mask is not None:
+            window._mask = self.mask[window_slices]
+        local = tuple(slice(s.start - w.start, s.stop - w.start) for s, w in zip(slices, window_slices))
+        return window, local, window_slices
+
+    def difference_range(self, tile):
+        window, local, _ = self.window(tile.core, self.mask_halo)
+        difference = window.background_difference()[local]
+        return difference.min(), difference.max()
+
+    def calculate_mask(self, tile, difference_range, value_range):
+        """
+        Calculates background mask in the core of the tile and adds its pixels to histograms (counts and sums)
+        of all pixels and of background pixels of the frame.
+        """
+        window, local, _ = self.window(tile.core, self.mask_halo)
+        background_mask = window.calculate_background_mask(difference_range)[local]
+        if window._mask is not None:
+            background_mask |= np.logical_not(window._mask[local])
+        self.background_mask[tile.core] = background_mask
+
+        image = self.image[tile.core]
+        histograms = []
+        for values in [image, image[background_mask]]:
+            histograms.append(np.histogram(values, MEDIAN_BINS, value_range)[0])
+            histograms.append(np.histogram(values, MEDIAN_BINS, value_range, weights=values)[0])
+        with self.lock:
+            self.histograms += histograms
+
+    def calculate(self, tiles, map_tiles=map):
+        """
+        Calculates background mask and median of background of the frame, then background core by core.
+        @type tiles: list[Tile]
+        @param map_tiles: function mapping tiles, e.g. map of a pool
+        @return: background of the frame
+        @rtype: np.ndarray
+        """
+        ranges = list(map_tiles(self.difference_range, tiles))
+        difference_range = min(r[0] for r in ranges), max(r[1] for r in ranges)
+        value_range = float(self.image.min()), float(self.image.max())
+        if value_range[0] == value_range[1]:
+            value_range = value_range[0], value_range[0] + 1
+
+        self.background_mask = np.zeros(self.image.shape, dtype=bool)
+        self.histograms = np.zeros((4, MEDIAN_BINS))
+        list(map_tiles(lambda tile: self.calculate_mask(tile, difference_range, value_range), tiles))
+        if self.histograms[2].any():
+            self.filler_value = histogram_median(self.histograms[2], self.histograms[3])
+        else:
+            self.filler_value = histogram_median(self.histograms[0], self.histograms[1])
+        self.histograms = None
+
+        background = np.empty(self.image.shape, dtype=self.float_type)
+
+        def core_background(tile):
+            background[tile.core] = self.window_background(tile.core)
+
+        list(map_tiles(core_background, tiles))
+        self.background_mask = None
+        return background
+
+    def window_background(self, slices):
+        """
+        @param slices: part of the frame
+        @return: background in the part of the frame
+        @rtype: np.ndarray
+        """
+        window, local, window_slices = self.window(slices, self.spread_halo + self.coarse_halo, self.factor)
+        background_mask = self.background_mask[window_slices]
+        if self.coarse_steps == 0:
+            background = np.where(background_mask, window.image, self.filler_value)
+        else:
+            known = image_downsample(window.image * background_mask, self.factor)
+            known_weight = image_downsample(background_mask, self.factor)
+            coarse = ImageRepo.spread_coarse_background(known + self.filler_value * (1 - known_weight),
+                                                        known, known_weight,
+                                                        self.radiuses[:self.coarse_steps], self.factor)
+            background = image_upsample(coarse, self.factor, window.image.shape)
+            background = background * np.logical_not(background_mask) + window.image * background_mask
+
+        # the full resolution steps need only the part extended by their halo
+        fine = tuple(slice(s.start - w.start, s.stop - w.start)
+                     for s, w in zip(extend(slices, self.spread_halo, self.image.shape), window_slices))
+        window = ImageRepo(window.image[fine], self.parameters)
+        local = tuple(slice(s.start - f.start, s.stop - f.start) for s, f in zip(local, fine))
+        background = window.spread_background(background[fine], background_mask[fine],
+                                              self.radiuses[self.coarse_steps:], self.coarse_steps == 0)
+        return window.store(background[local])
+
+
+def frame_statistics(image, background, tiles, map_tiles=map):
+    """
+    Calculates statistics of difference of image and background which tiles of the frame share so that
+    their intermediate images are normalized in the same way (see ImageRepo.frame_statistics).
+    @param image: image of the frame
+    @param background: background of the frame
+    @type tiles: list[Tile]
+    @param map_tiles: function mapping tiles, e.g. map of a pool
+    @return: range and mean of the difference
+    @rtype: dict
+    """
+    def core_statistics(tile):
+        difference = image[tile.core] - background[tile.core]
+        return difference.min(), difference.max(), difference.sum(dtype=float)
+
+    statistics = list(map_tiles(core_statistics, tiles))
+    return {"difference_range": (float(min(s[0] for s in statistics)), float(max(s[1] for s in statistics))),
+            "difference_mean": sum(s[2] for s in statistics) / image.size}
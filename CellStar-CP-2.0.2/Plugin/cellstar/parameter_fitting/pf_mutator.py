@@ -6,7 +6,6 @@ Website: http://cellstar-algorithm.org/
 """
 
 import copy
-import random
 
 import numpy as np
 
@@ -14,13 +13,13 @@ from cellstar.core.point import *
 from cellstar.utils.calc_util import polar_to_cartesian
 
 
-def add_mutations(gt_and_grown, avg_cell_diameter):
+def add_mutations(gt_and_grown, avg_cell_diameter, generator):
     mutants = []
     mutation_radiuses = 0.2 * avg_cell_diameter
     for (gt, grown) in gt_and_grown:
         mutants += [
-            (gt, grown.create_mutation(mutation_radiuses * 2, random_poly=True)),
-            (gt, grown.create_mutation(-mutation_radiuses * 2, random_poly=True)),
+            (gt, grown.create_mutation(mutation_radiuses * 2, random_poly=True, generator=generator)),
+            (gt, grown.create_mutation(-mutation_radiuses * 2, random_poly=True, generator=generator)),
             (gt, grown.create_mutation(mutation_radiuses)), (gt, grown.create_mutation(-mutation_radiuses)),
         ]
     return gt_and_grown + mutants
@@ -50,7 +49,7 @@ def create_mutant_from_change(org_snake, polar_transform, boundary_change):
     return mutant_snake
 
 
-def create_poly_mutation(org_snake, polar_transform, max_diff):
+def create_poly_mutation(org_snake, polar_transform, max_diff, generator):
     # change to pixels
     length = org_snake.polar_coordinate_boundary.size
     max_diff /= polar_transform.step
@@ -61,7 +60,7 @@ def create_poly_mutation(org_snake, polar_transform, max_diff):
 
         return eval
 
-    poly = polynomial(random.uniform(0.001, length), random.uniform(0.001, length))
+    poly = polynomial(generator.uniform(0.001, length), generator.uniform(0.001, length))
     boundary_change = np.array([poly(x) for x in range(length)])
 
     M = abs(boundary_change).max()
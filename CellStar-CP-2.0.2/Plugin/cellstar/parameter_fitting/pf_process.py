@@ -6,7 +6,6 @@ Website: http://cellstar-algorithm.org/
 """
 
 import copy
-import random
 import sys
 import time
 from multiprocessing import Process, Queue
@@ -15,18 +14,16 @@ import numpy as np
 import scipy.optimize as opt
 from scipy.linalg import norm
 
-random.seed(1)
-np.random.seed(1)
-
 import logging
 
 logger = logging.getLogger(__name__)
 
 from cellstar.utils.params_util import *
-from cellstar.core.seed import Seed
+from cellstar.core.seed import Seed, SeedBatch
 from cellstar.core.image_repo import ImageRepo
 from cellstar.parameter_fitting.pf_snake import PFSnake, GTSnake
 from cellstar.core.seeder import Seeder
+from cellstar.utils.calc_util import random_generator
 from cellstar.utils.debug_util import explore_cellstar
 from cellstar.parameter_fitting.pf_auto_params import pf_parameters_encode, pf_parameters_decode
 
@@ -115,22 +112,25 @@ def snakes_fitness(gt_snake_seed_pairs, images, parameters, pf_param_vector, deb
 #
 
 
-def get_gt_snake_seeds(gt_snake, number, max_radius, min_radius=0):
+def get_gt_snake_seeds(gt_snake, number, max_radius, generator, min_radius=0):
     """
     Create random seeds inside gt snake.
     @type gt_snake: GTSnake
+    @param generator: random generator used to draw seeds
+    @type generator: np.random.Generator
     """
     seed = Seed(gt_snake.centroid_x, gt_snake.centroid_y, "optimize_star_parameters")
-    seeds = [seed]
+    centroid = SeedBatch.from_seeds([seed])
+    inside_seeds = []
     left = number
     while left > 0:
-        random_seeds = Seeder.rand_seeds(max_radius, left, [seed], min_random_radius=min_radius)
-        inside_seeds = [s for s in random_seeds if gt_snake.is_inside(s.x, s.y)]
-        seeds += inside_seeds
-        left = number - (len(seeds) - 1)
+        random_seeds = Seeder.rand_seeds(max_radius, left, centroid, generator, min_random_radius=min_radius)
+        inside = gt_snake.are_inside(random_seeds.x, random_seeds.y)
+        inside_seeds.append(random_seeds.select(inside))
+        left -= np.count_nonzero(inside)
         min_radius /= 1.1  # make sure that it finish
 
-    return seeds
+    return [seed] + SeedBatch.concatenate(inside_seeds).to_seeds()
 
 
 def get_size_weight_list(params):
@@ -140,19 +140,19 @@ def get_size_weight_list(params):
     return size_weight
 
 
-def prepare_snake_seed_pairs(gt_snakes, initial_parameters):
+def prepare_snake_seed_pairs(gt_snakes, initial_parameters, generator):
     radius = initial_parameters["segmentation"]["seeding"]["randomDiskRadius"] * initial_parameters["segmentation"][
         "avgCellDiameter"]
     for gt_snake in gt_snakes:
         gt_snake.set_erosion(4)
     gt_snake_seed_pairs = [(gt_snake, seed) for gt_snake in gt_snakes for seed in
-                           get_gt_snake_seeds(gt_snake, number=3, max_radius=radius, min_radius=2 * radius / 3.0)]
-    random.shuffle(gt_snake_seed_pairs)
-    return gt_snake_seed_pairs
+                           get_gt_snake_seeds(gt_snake, number=3, max_radius=radius, generator=generator,
+                                              min_radius=2 * radius / 3.0)]
+    return [gt_snake_seed_pairs[i] for i in generator.permutation(len(gt_snake_seed_pairs))]
 
 
-def pf_get_distances(gt_snakes, images, initial_parameters, callback=None):
-    gt_snake_seed_pairs = prepare_snake_seed_pairs(gt_snakes, initial_parameters)
+def pf_get_distances(gt_snakes, images, initial_parameters, generator, callback=None):
+    gt_snake_seed_pairs = prepare_snake_seed_pairs(gt_snakes, initial_parameters, generator)
     pick_seed_pairs = max(min_number_of_chosen_seeds, max_number_of_chosen_snakes //
                           len(initial_parameters["segmentation"]["stars"]["sizeWeight"]))
     chosen_gt_snake_seed_pairs = gt_snake_seed_pairs[:pick_seed_pairs]
@@ -189,7 +189,7 @@ def pf_get_distances(gt_snakes, images, initial_parameters, callback=None):
 #
 
 def run(image, gt_snakes, precision, avg_cell_diameter, method='brute', initial_params=None, background_image=None,
-        ignore_mask=None):
+        ignore_mask=None, random_seed=1):
     global best_3, calculations
     """
     :param image: input image
@@ -198,6 +198,7 @@ def run(image, gt_snakes, precision, avg_cell_diameter, method='brute', initial_
     :param avg_cell_diameter: if initial_params is None then it is used to calculate parameters
     :param method: optimization engine
     :param initial_params: overrides precision and avg_cell_diameter
+    :param random_seed: seed of the random generator used in fitting, None for a random one
     :return:
     """
     logger.info("Parameter fitting started...")
@@ -213,7 +214,8 @@ def run(image, gt_snakes, precision, avg_cell_diameter, method='brute', initial_
     start = time.time()
     best_3 = []
     calculations = 0
-    best_arg, best_score = optimize(method, gt_snakes, images, params, precision, avg_cell_diameter)
+    generator = random_generator(random_seed)
+    best_arg, best_score = optimize(method, gt_snakes, images, params, precision, avg_cell_diameter, generator)
 
     best_params = pf_parameters_decode(best_arg, get_size_weight_list(params))
 
@@ -224,7 +226,7 @@ def run(image, gt_snakes, precision, avg_cell_diameter, method='brute', initial_
     return PFSnake.merge_parameters(params, best_params), best_arg, best_score
 
 
-def optimize(method_name, gt_snakes, images, params, precision, avg_cell_diameter):
+def optimize(method_name, gt_snakes, images, params, precision, avg_cell_diameter, generator):
     global max_number_of_chosen_snakes, estimated_calculations_number
 
     search_length = SEARCH_LENGTH_NORMAL
@@ -239,7 +241,7 @@ def optimize(method_name, gt_snakes, images, params, precision, avg_cell_diamete
         pass
 
     encoded_params = pf_parameters_encode(params)
-    complete_distance, fast_distance = pf_get_distances(gt_snakes, images, params)
+    complete_distance, fast_distance = pf_get_distances(gt_snakes, images, params, generator)
     initial_distance = fast_distance(encoded_params)
     initial_complete_distance = complete_distance(encoded_params)
     logger.debug("Initial parameters complete-distance is (%f)." % (initial_complete_distance))
@@ -256,25 +258,27 @@ def optimize(method_name, gt_snakes, images, params, precision, avg_cell_diamete
                                                                     avg_cell_diameter, "superfit", params)
     else:
         if method_name == 'brute':
-            best_params_encoded, distance = optimize_brute(encoded_params, fast_distance)
+            best_params_encoded, distance = optimize_brute(encoded_params, fast_distance, generator)
         elif method_name == 'brutemaxbasin':
-            best_params_encoded, distance = optimize_brute(encoded_params, fast_distance)
+            best_params_encoded, distance = optimize_brute(encoded_params, fast_distance, generator)
             logger.debug("Best grid parameters distance is (%f)." % distance)
-            best_params_encoded, distance = optimize_basinhopping(best_params_encoded, fast_distance, time_percent=search_length)
+            best_params_encoded, distance = optimize_basinhopping(best_params_encoded, fast_distance, generator,
+                                                                  time_percent=search_length)
         elif method_name == 'brutemax3basin':
-            _, _ = optimize_brute(encoded_params, fast_distance)
+            _, _ = optimize_brute(encoded_params, fast_distance, generator)
             best_3_unzip = list(zip(*best_3))
             logger.debug("Best grid parameters distance are %s." % str(best_3_unzip[0]))
             logger.debug("3-best grid parameters  are %s." % str(best_3_unzip[1]))
 
             best_basins = []
             for candidate in list(best_3):
-                best_basins.append(optimize_basinhopping(candidate[1], fast_distance, time_percent=search_length//3))
+                best_basins.append(optimize_basinhopping(candidate[1], fast_distance, generator,
+                                                          time_percent=search_length//3))
             best_basins.sort(key=lambda x: x[1])
 
             best_params_encoded, distance = best_basins[0]
         elif method_name == 'basin':
-            best_params_encoded, distance = optimize_basinhopping(encoded_params, fast_distance)
+            best_params_encoded, distance = optimize_basinhopping(encoded_params, fast_distance, generator)
 
     complete_distance = complete_distance(best_params_encoded)
     logger.debug("Final parameters complete-distance is (%f)." % (complete_distance))
@@ -286,14 +290,14 @@ def optimize(method_name, gt_snakes, images, params, precision, avg_cell_diamete
         return best_params_encoded, complete_distance
 
 
-def optimize_brute(params_to_optimize, distance_function):
+def optimize_brute(params_to_optimize, distance_function, generator):
     lower_bound = params_to_optimize - np.maximum(np.abs(params_to_optimize), 0.1)
     upper_bound = params_to_optimize + np.maximum(np.abs(params_to_optimize), 0.1)
 
     # introduce random shift (0,grid step) # max 20%
     number_of_steps = 5
     step = (upper_bound - lower_bound) / float(number_of_steps)
-    random_shift = np.array([random.random() * 2 / 10 for _ in range(len(lower_bound))])
+    random_shift = generator.uniform(0, 0.2, len(lower_bound))
     lower_bound += random_shift * step
     upper_bound += random_shift * step
 
@@ -305,13 +309,13 @@ def optimize_brute(params_to_optimize, distance_function):
     return result[0], result[1]
 
 
-def optimize_basinhopping(params_to_optimize, distance_function, time_percent=100):
+def optimize_basinhopping(params_to_optimize, distance_function, generator, time_percent=100):
     minimizer_kwargs = {"method": "COBYLA"}
     # bounds = ContourBounds
     # minimizer_kwargs = {"method": "L-BFGS-B", "bounds" : list(zip(bounds.xmin,bounds.xmax))}
     bounds = None
     result = opt.basinhopping(distance_function, params_to_optimize, accept_test=bounds,
-                              minimizer_kwargs=minimizer_kwargs, niter=35 * time_percent // 100)
+                              minimizer_kwargs=minimizer_kwargs, niter=35 * time_percent // 100, seed=generator)
     logger.debug("Opt finished: " + str(result))
     return result.x, result.fun
 
@@ -355,9 +359,8 @@ def general_multiproc_fitting(run_wrapper, *args):
 
 def run_wrapper(queue, update_queue, *args):
     global callback_progress
-    random.seed()  # reseed with random
     callback_progress = lambda p: update_queue.put(p)
-    result = run(*args)
+    result = run(*args, random_seed=None)  # every worker searches differently
     queue.put(result)
 
 
@@ -6,16 +6,12 @@ Website: http://cellstar-algorithm.org/
 """
 import functools
 import operator as op
-import random
 import time
 
 import numpy as np
 import scipy.optimize as opt
 from scipy.linalg import norm
 
-random.seed(1)
-np.random.seed(1)
-
 import logging
 
 logger = logging.getLogger(__name__)
@@ -23,6 +19,7 @@ logger = logging.getLogger(__name__)
 from cellstar.utils.params_util import *
 from cellstar.core.image_repo import ImageRepo
 from cellstar.core.snake_filter import SnakeFilter
+from cellstar.utils.calc_util import random_generator
 from cellstar.utils.debug_util import explore_cellstar
 from cellstar.parameter_fitting.pf_process import get_gt_snake_seeds, grow_single_seed, \
     general_multiproc_fitting
@@ -174,13 +171,14 @@ def run_multiprocess(image, gt_snakes, precision=None, avg_cell_diameter=None, m
 
 
 def run_singleprocess(image, gt_snakes, precision=None, avg_cell_diameter=None, method='brute', initial_params=None,
-                      background_image=None, ignore_mask=None):
+                      background_image=None, ignore_mask=None, random_seed=1):
     """
     :param gt_snakes: gt snakes label image
     :param precision: if initial_params is None then it is used to calculate parameters
     :param avg_cell_diameter: if initial_params is None then it is used to calculate parameters
     :param method: optimization engine
     :param initial_params: overrides precision and avg_cell_diameter
+    :param random_seed: seed of the random generator used in fitting, None for a random one
     :return:
     """
     global calculations
@@ -193,6 +191,7 @@ def run_singleprocess(image, gt_snakes, precision=None, avg_cell_diameter=None,
         avg_cell_diameter = params["segmentation"]["avgCellDiameter"]
 
     start = time.time()
+    generator = random_generator(random_seed)
 
     images = ImageRepo(image, params)
     images.background = background_image
@@ -204,9 +203,11 @@ def run_singleprocess(image, gt_snakes, precision=None, avg_cell_diameter=None,
     radius = params["segmentation"]["seeding"]["randomDiskRadius"] * params["segmentation"]["avgCellDiameter"]
     radius_big = params["segmentation"]["avgCellDiameter"] * 1.5
     gt_snake_seed_pairs = [(gt_snake, seed) for gt_snake in gt_snakes for seed in
-                           get_gt_snake_seeds(gt_snake, max_radius=radius, number=8, min_radius=2 * radius / 3.0)
-                           + get_gt_snake_seeds(gt_snake, max_radius=radius, number=8, min_radius=4 * radius / 5.0)
-                           + get_gt_snake_seeds(gt_snake, max_radius=radius_big, number=8,
+                           get_gt_snake_seeds(gt_snake, max_radius=radius, number=8, generator=generator,
+                                              min_radius=2 * radius / 3.0)
+                           + get_gt_snake_seeds(gt_snake, max_radius=radius, number=8, generator=generator,
+                                                min_radius=4 * radius / 5.0)
+                           + get_gt_snake_seeds(gt_snake, max_radius=radius_big, number=8, generator=generator,
                                                 min_radius=3 * radius_big / 4.0)
                            ]
 
@@ -221,7 +222,7 @@ def run_singleprocess(image, gt_snakes, precision=None, avg_cell_diameter=None,
     # gt_snake_grown_seed_pairs_filtered = filter_snakes_as_singles(params, images, gt_snake_grown_seed_pairs_all)
     gt_snake_grown_seed_pairs_filtered = gt_snake_grown_seed_pairs_all
 
-    # gts_snakes_with_mutations = add_mutations(gt_snake_grown_seed_pairs_all, avg_cell_diameter)
+    # gts_snakes_with_mutations = add_mutations(gt_snake_grown_seed_pairs_all, avg_cell_diameter, generator)
     gts_snakes_with_mutations = gt_snake_grown_seed_pairs_filtered
     ranked_snakes = list(zip(*gts_snakes_with_mutations))[1]
 
@@ -233,7 +234,8 @@ def run_singleprocess(image, gt_snakes, precision=None, avg_cell_diameter=None,
     best_params_encoded, distance = optimize(
         method,
         pf_rank_parameters_encode(params),
-        pf_rank_get_ranking(ranked_snakes, params)
+        pf_rank_get_ranking(ranked_snakes, params),
+        generator
     )
 
     stop = time.time()
@@ -257,15 +259,15 @@ def run_singleprocess(image, gt_snakes, precision=None, avg_cell_diameter=None,
 #
 #
 
-def optimize(method_name, encoded_params, distance_function):
+def optimize(method_name, encoded_params, distance_function, generator):
     initial_distance = distance_function(encoded_params)
     logger.debug("Initial parameters distance is (%f)." % initial_distance)
     if method_name == 'brute':
-        best_params_encoded, distance = optimize_brute(encoded_params, distance_function)
+        best_params_encoded, distance = optimize_brute(encoded_params, distance_function, generator)
     elif method_name == 'brutemaxbasin' or method_name == 'superfit':
-        best_params_encoded, distance = optimize_brute(encoded_params, distance_function)
+        best_params_encoded, distance = optimize_brute(encoded_params, distance_function, generator)
         logger.debug("Best grid parameters distance is (%f)." % distance)
-        best_params_encoded, distance = optimize_basinhopping(best_params_encoded, distance_function)
+        best_params_encoded, distance = optimize_basinhopping(best_params_encoded, distance_function, generator)
     else:
         raise Exception("No such optimization method.")
 
@@ -276,14 +278,14 @@ def optimize(method_name, encoded_params, distance_function):
         return best_params_encoded, distance
 
 
-def optimize_brute(params_to_optimize, distance_function):
+def optimize_brute(params_to_optimize, distance_function, generator):
     lower_bound = np.zeros(len(params_to_optimize), dtype=float)
     upper_bound = np.ones(len(params_to_optimize), dtype=float)
 
     # introduce random shift (0,grid step) # max 10%
     number_of_steps = 6
     step = (upper_bound - lower_bound) / float(number_of_steps)
-    random_shift = np.array([random.random() * 1 / 10 for _ in range(len(lower_bound))], dtype=float)
+    random_shift = generator.uniform(0, 0.1, len(lower_bound))
     lower_bound += random_shift * step
     upper_bound += random_shift * step
 
@@ -297,12 +299,12 @@ def optimize_brute(params_to_optimize, distance_function):
     return result[0], result[1]
 
 
-def optimize_basinhopping(params_to_optimize, distance_function):
+def optimize_basinhopping(params_to_optimize, distance_function, generator):
     bounds = RankBounds
     # minimizer_kwargs = {"method": "COBYLA", bounds=bounds}
     minimizer_kwargs = {"method": "L-BFGS-B", "bounds": list(zip(bounds.xmin, bounds.xmax))}
     result = opt.basinhopping(distance_function, params_to_optimize, accept_test=bounds,
-                              minimizer_kwargs=minimizer_kwargs, niter=170)
+                              minimizer_kwargs=minimizer_kwargs, niter=170, seed=generator)
     logger.debug("Opt finished: " + str(result))
     return result.x, result.fun
 
@@ -315,10 +317,10 @@ def optimize_basinhopping(params_to_optimize, distance_function):
 
 def run_wrapper(queue, update_queue, images, gt_snakes, method, params):
     global callback_progress
-    random.seed()  # reseed with random
     callback_progress = lambda p: update_queue.put(p)
+    # every worker searches differently
     result = run_singleprocess(images[0], gt_snakes, method=method, initial_params=params, background_image=images[1],
-                               ignore_mask=images[2])
+                               ignore_mask=images[2], random_seed=None)
     queue.put(result)
 
 
@@ -6,9 +6,6 @@ Website: http://cellstar-algorithm.org/
 """
 
 import copy
-import random
-
-random.seed(1)  # make it deterministic
 
 from cellstar.core.polar_transform import PolarTransform
 from cellstar.parameter_fitting.pf_snake import PFSnake
@@ -33,9 +30,13 @@ class PFRankSnake(object):
         return [(gt_snake, PFRankSnake(gt_snake, snake, grown_pf_snake.avg_cell_diameter, params)) for snake in
                 grown_pf_snake.snakes]
 
-    def create_mutation(self, dilation, random_poly=False):
+    def create_mutation(self, dilation, random_poly=False, generator=None):
+        """
+        @param generator: random generator used to create polynomial mutation
+        @type generator: np.random.Generator
+        """
         if random_poly:
-            mutant = pf_mutator.create_poly_mutation(self.grown_snake, self.polar_transform, dilation)
+            mutant = pf_mutator.create_poly_mutation(self.grown_snake, self.polar_transform, dilation, generator)
         else:
             mutant = pf_mutator.create_mutation(self.grown_snake, self.polar_transform, dilation)
         return PFRankSnake(self.gt_snake, mutant, self.avg_cell_diameter, self.initial_parameters)
@@ -7,15 +7,13 @@ Website: http://cellstar-algorithm.org/
 """
 
 import copy
-import random
 
-random.seed(1)  # make it deterministic
 import numpy as np
 import scipy.ndimage.morphology as morph
 import scipy.ndimage.measurements as measure
 
-from cellstar.utils.calc_util import to_int
 from cellstar.core.seed import Seed
+from cellstar.core.batch_grow import BatchGrower
 from cellstar.core.snake import Snake
 from cellstar.core.polar_transform import PolarTransform
 
@@ -63,14 +61,14 @@ class PFSnake(object):
         s = Snake.create_from_seed(new_parameters, self.seed, self.point_number, self.images)
 
         size_weight_list = new_parameters["segmentation"]["stars"]["sizeWeight"]
-        snakes_to_grow = [(copy.copy(s), w) for w in size_weight_list]
+        grower = BatchGrower(self.images, new_parameters, self.polar_transform)
+        grown_snakes = grower.grow_size_weights([s], size_weight_list)[0]
 
-        for snake, weight in snakes_to_grow:
-            snake.grow(size_weight=weight, polar_transform=self.polar_transform)
+        for snake in grown_snakes:
             snake.evaluate(self.polar_transform)
 
-        self.snakes = [grown_snake for grown_snake, _ in snakes_to_grow]
-        self.best_snake = sorted(snakes_to_grow, key=lambda snb: snb[0].rank)[0][0]
+        self.snakes = grown_snakes
+        self.best_snake = sorted(grown_snakes, key=lambda sn: sn.rank)[0]
 
         return self
 
@@ -137,13 +135,17 @@ class GTSnake(object):
     def set_erosion(self, size):
         self.eroded_mask = morph.binary_erosion(self.binary_mask, np.ones((size, size)))
 
-    def is_inside(self, x, y):
+    def are_inside(self, xs, ys):
         """
-        Check if seed is inside of eroded mask.
-        @type seed: Seed
+        Check which of the seeds are inside of eroded mask.
+        @param xs: x coordinates of seeds
+        @type xs: np.ndarray
+        @param ys: y coordinates of seeds
+        @type ys: np.ndarray
+        @rtype: np.ndarray
         """
-        x = to_int(x)
-        y = to_int(y)
-        if x < 0 or x >= self.eroded_mask.shape[1] or y < 0 or y >= self.eroded_mask.shape[0]:
-            return False
-        return self.eroded_mask[y, x]
+        xs = np.trunc(xs).astype(int)
+        ys = np.trunc(ys).astype(int)
+        inside = (xs >= 0) & (xs < self.eroded_mask.shape[1]) & (ys >= 0) & (ys < self.eroded_mask.shape[0])
+        inside[inside] = self.eroded_mask[ys[inside], xs[inside]]
+        return inside
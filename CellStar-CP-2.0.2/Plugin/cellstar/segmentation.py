@@ -7,33 +7,45 @@ Website: http://cellstar-algorithm.org/
 
 import ast
 import logging
+import multiprocessing.pool
 
 logger = logging.getLogger(__name__)
-from copy import copy
+from copy import copy, deepcopy
 
 from cellstar.utils.params_util import *
 from cellstar.core.image_repo import ImageRepo
 from cellstar.utils.params_util import default_parameters
-from cellstar.utils import image_util, debug_util
+from cellstar.utils import calc_util, image_util, debug_util
+from cellstar.core.batch_grow import BatchGrower
+from cellstar.core.parallel import snake_grow as parallel_grow
+from cellstar.core.seed import SeedBatch
 from cellstar.core.seeder import Seeder
 from cellstar.core.snake import Snake
 from cellstar.core.snake_filter import SnakeFilter
+from cellstar.core import tiling
 from cellstar.core.polar_transform import PolarTransform
 from cellstar.parameter_fitting.pf_auto_params import rank_parameters_range as rank_auto_params
 from cellstar.parameter_fitting.pf_auto_params import parameters_range as snake_auto_params
 
 
 class Segmentation(object):
-    def __init__(self, segmentation_precision=9, avg_cell_diameter=35):
+    def __init__(self, segmentation_precision=9, avg_cell_diameter=35, random_seed=None):
+        """
+        @param random_seed: seed of random generator used in segmentation, if None it is derived from every frame
+        so that segmentation of the same frame is reproducible
+        """
         self.parameters = default_parameters(segmentation_precision, avg_cell_diameter)
         self.images = None
-        self.all_seeds = []
-        self.seeds = []
-        self.grown_seeds = set()  # seeds from which we already have snakes
+        self.random_seed = random_seed
+        self.random_generator = None
+        self.all_seeds = SeedBatch.empty()
+        self.seeds = SeedBatch.empty()
+        self.grown_seeds = set()  # keys of seeds from which we already have snakes
         self.snakes = []
         self.new_snakes = []
         self._seeder = None
         self._filter = None
+        self._pool_grower = None
         self.polar_transform = PolarTransform.instance(self.parameters["segmentation"]["avgCellDiameter"],
                                                        self.parameters["segmentation"]["stars"]["points"],
                                                        self.parameters["segmentation"]["stars"]["step"],
@@ -54,9 +66,34 @@ class Segmentation(object):
 
         return self._filter
 
+    @property
+    def executor(self):
+        executor = self.parameters["segmentation"]["processing"]["executor"]
+        if executor == "process" and not parallel_grow.is_available():
+            logger.warning("Process executor requires multiprocessing.shared_memory, using serial one instead.")
+            executor = "serial"
+        return executor
+
+    @property
+    def pool_grower(self):
+        if self._pool_grower is None:
+            workers = parallel_grow.workers_number(self.parameters)
+            if self.executor == "process":
+                self._pool_grower = parallel_grow.ProcessPoolGrower(self.images, self.parameters, workers)
+            else:
+                self._pool_grower = parallel_grow.ThreadPoolGrower(self.images, self.parameters,
+                                                                   self.polar_transform, workers)
+
+        return self._pool_grower
+
+    def close_executor(self):
+        if self._pool_grower is not None:
+            self._pool_grower.close()
+            self._pool_grower = None
+
     def clear_lists(self):
-        self.all_seeds = []
-        self.seeds = []
+        self.all_seeds = SeedBatch.empty()
+        self.seeds = SeedBatch.empty()
         self.grown_seeds = set()
         self.snakes = []
         self.new_snakes = []
@@ -66,8 +103,13 @@ class Segmentation(object):
         prev_background = None
         if self.images is not None:
             prev_background = self.images.background
+        # Workers, seeder and filter hold images of the previous frame
+        self.close_executor()
+        self._seeder = None
+        self._filter = None
         # Initialize new image repository for new frame
         self.images = ImageRepo(frame, self.parameters)
+        self.init_random_generator()
         # One background per whole segmentation
         if prev_background is not None:
             self.images.background = prev_background
@@ -82,8 +124,14 @@ class Segmentation(object):
         if ignore_mask is not None:
             self.images.apply_mask(ignore_mask)
 
+    def init_random_generator(self):
+        seed = self.random_seed
+        if seed is None:
+            seed = abs(np.sum(self.images.image).astype(np.int64))
+        self.random_generator = calc_util.random_generator(seed)
+
     def init_seeder(self):
-        self._seeder = Seeder(self.images, self.parameters)
+        self._seeder = Seeder(self.images, self.parameters, self.random_generator)
 
     def init_filter(self):
         self._filter = SnakeFilter(self.images, self.parameters)
@@ -153,64 +201,46 @@ class Segmentation(object):
         return Segmentation.encode_auto_params_from_all_params(self.parameters)
 
     def pre_process(self):
-        # background getter is never None but it creation background only if not existant
-        if self.images.background is None:
-            self.images.calculate_background()
-
-        self.images.calculate_brighter_original()
-        self.images.calculate_darker_original()
-        self.images.calculate_clean_original()
-        self.images.calculate_forebackground_masks()
-
-        self.images.calculate_clean()
-        self.images.calculate_brighter()
-        self.images.calculate_darker()
-
-        self.images.calculate_cell_border_content_mask()
+        # independent preprocessing steps run in threads if snakes are grown in parallel
+        workers = 1
+        if self.executor in ["process", "thread"]:
+            workers = parallel_grow.workers_number(self.parameters)
+        self.images.pre_process(workers)
 
     def find_seeds(self, exclude):
         self.seeds = self.seeder.find_seeds(self.snakes, self.all_seeds, exclude_current_segments=exclude)
         self.all_seeds += self.seeds
 
     def snakes_from_seeds(self):
+        seeds_keys = self.seeds.keys()
         self.new_snakes = [
             Snake.create_from_seed(
-                self.parameters, seed, self.parameters["segmentation"]["stars"]["points"], self.images
+                self.parameters, self.seeds.seed(i), self.parameters["segmentation"]["stars"]["points"], self.images
             )
-            for seed in self.seeds if seed not in self.grown_seeds
+            for i, key in enumerate(seeds_keys) if key not in self.grown_seeds
         ]
-        for seed in self.seeds:
-            if seed not in self.grown_seeds:
-                self.grown_seeds.add(seed)
+        self.grown_seeds.update(seeds_keys)
 
     def grow_snakes(self):
-        grown_snakes = []
         size_weights = self.parameters["segmentation"]["stars"]["sizeWeight"]
         logger.debug("%d snakes seeds to grow with %d weights options -> %d snakes to calculate"%(len(self.new_snakes), len(size_weights), len(self.new_snakes) * len(size_weights)))
-        for snake in self.new_snakes:
-            best_snake = None
-            for weight in size_weights:
-                curr_snake = copy(snake)
-
-                curr_snake.grow(weight, self.polar_transform)
-                curr_snake.evaluate(self.polar_transform)
-
-                if best_snake is None:
-                    best_snake = curr_snake
-                else:
-                    if curr_snake.rank < best_snake.rank:
-                        best_snake = curr_snake
+        if self.executor in ["process", "thread"]:
+            self.new_snakes = self.pool_grower.grow(self.new_snakes, self.polar_transform)
+            return
 
-            grown_snakes.append(best_snake)
-
-        self.new_snakes = grown_snakes
+        grower = BatchGrower(self.images, self.parameters, self.polar_transform)
+        self.new_snakes = grower.grow_best(self.new_snakes, size_weights)
 
     def evaluate_snakes(self):
+        if self.executor in ["process", "thread"]:
+            self.pool_grower.evaluate(self.new_snakes, self.polar_transform)
+            return
+
         for snake in self.new_snakes:
             snake.evaluate(self.polar_transform)
 
     def filter_snakes(self):
-        self.snakes = self.filter.filter(self.snakes + self.new_snakes)
+        self.snakes = self.filter.filter_incremental(self.snakes, self.new_snakes)
         self.new_snakes = []
 
     def debug_images(self):
@@ -236,11 +266,96 @@ class Segmentation(object):
         self.filter_snakes()
         logger.debug("done")
 
+    @property
+    def tiled(self):
+        tile_size = self.parameters["segmentation"]["processing"]["tileSize"]
+        return 0 < tile_size < max(self.images.image.shape)
+
     def run_segmentation(self):
+        if self.tiled:
+            return self.run_tiled_segmentation()
+
         logger.debug("preproces...")
         self.pre_process()
         self.debug_images()
         debug_util.explore_cellstar(self)
-        for step in range(self.parameters["segmentation"]["steps"]):
-            self.run_one_step(step)
-        return self.images.segmentation, self.snakes
\ No newline at end of file
+        self.images.release_intermediates()
+        try:
+            for step in range(self.parameters["segmentation"]["steps"]):
+                self.run_one_step(step)
+        finally:
+            self.close_executor()
+        logger.debug("image repository memory: peak %(peak_bytes)d B, retained %(retained_bytes)d B, "
+                     "spilled %(spilled_bytes)d B" % self.images.memory_statistics())
+        logger.debug("blur cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions"
+                     % self.images.blur_cache_statistics())
+        return self.images.segmentation, self.snakes
+
+    def segment_tile(self, tile, parameters, frame_statistics):
+        """
+        Segments tile of the frame using background and statistics of the whole frame.
+        @type tile: cellstar.core.tiling.Tile
+        @param parameters: parameters of segmentation of the tile
+        @param frame_statistics: see ImageRepo.frame_statistics
+        @return: snakes with centroid in the core of the tile moved to the frame and cell content mask of the core
+        @rtype: (list[Snake], np.ndarray)
+        """
+        segmentation = copy(self)
+        segmentation.parameters = parameters
+        segmentation.images = None
+        segmentation._pool_grower = None
+        segmentation.set_frame(self.images.image[tile.slices])
+        segmentation.images.background = self.images.background[tile.slices]
+        if self.images._mask is not None:
+            segmentation.images._mask = self.images._mask[tile.slices]
+        segmentation.images.frame_statistics = frame_statistics
+
+        _, snakes = segmentation.run_segmentation()
+        snakes = [tiling.move_snake(snake, tile, self.images) for snake in snakes if tiling.in_core(snake, tile)]
+        logger.debug("%s: %d snakes in core" % (tile, len(snakes)))
+        return snakes, segmentation.images.cell_content_mask[tile.core_local]
+
+    def run_tiled_segmentation(self):
+        """
+        Segments frame bigger than processing tileSize in tiles with halo fitting the biggest snake. If background
+        is not set, it is calculated tile by tile (see TiledBackground) and kept for the next frames. Tiles are
+        processed in threads if snakes are grown in parallel (then snakes of every tile are grown serially)
+        and their snakes are stitched by filtering the ones crossing tile cores.
+        """
+        tiles = tiling.split_tiles(self.images.image.shape, self.parameters["segmentation"]["processing"]["tileSize"],
+                                   tiling.tile_halo(self.parameters))
+        logger.debug("segmenting %d tiles..." % len(tiles))
+
+        parameters = deepcopy(self.parameters)
+        parameters["segmentation"]["processing"]["tileSize"] = 0
+        workers = 1
+        if self.executor in ["process", "thread"]:
+            workers = min(parallel_grow.workers_number(self.parameters), len(tiles))
+        pool = None
+        map_tiles = lambda function, items: list(map(function, items))
+        if workers > 1:
+            parameters["segmentation"]["processing"]["executor"] = "serial"
+            pool = multiprocessing.pool.ThreadPool(processes=workers)
+            map_tiles = pool.map
+
+        try:
+            if self.images._background is None:
+                logger.debug("tiled background...")
+                tiled_background = tiling.TiledBackground(self.images.image, self.images._mask, self.parameters)
+                self.images.background = tiled_background.calculate(tiles, map_tiles)
+            frame_statistics = tiling.frame_statistics(self.images.image, self.images.background, tiles, map_tiles)
+            results = map_tiles(lambda tile: self.segment_tile(tile, parameters, frame_statistics), tiles)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.images._cell_content_mask = np.zeros(self.images.image.shape, dtype=bool)
+        for tile, (_, cell_content_mask) in zip(tiles, results):
+            self.images._cell_content_mask[tile.core] = cell_content_mask
+
+        self.clear_lists()
+        self.filter.reset()
+        self.snakes = tiling.stitch_snakes(tiles, [snakes for snakes, _ in results], self.filter)
+        logger.debug("%d snakes stitched from tiles" % len(self.snakes))
+        return self.images.segmentation, self.snakes
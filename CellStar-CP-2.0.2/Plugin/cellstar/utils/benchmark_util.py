@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark util measures time and memory used by the time critical parts of CellStar segmentation.
+Date: 2013-2016
+Website: http://cellstar-algorithm.org/
+"""
+
+import copy
+import sys
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+def peak_rss_mb():
+    """
+    @return: peak resident set size of the process in MB or None if it cannot be determined
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # bytes instead of kilobytes
+        peak /= 1024.0
+    return peak / 1024.0
+
+
+def benchmark_evaluate(snakes, polar_transform, repeats=1):
+    """
+    Measure evaluation of already grown snakes. Copies of snakes are evaluated so the given snakes are not modified.
+    Allocator churn is measured as the peak of memory traced during every single evaluation,
+    which shows how much memory is allocated and released again per snake.
+    @type snakes: list[cellstar.core.snake.Snake]
+    @type polar_transform: cellstar.core.polar_transform.PolarTransform
+    @param repeats: number of evaluations of every snake
+    @return: measured values
+    @rtype: dict
+    """
+    results = {"snakes": len(snakes) * repeats}
+
+    copies = []
+    for _ in range(repeats):
+        for snake in snakes:
+            snake_copy = copy.copy(snake)
+            snake_copy.rank = None
+            copies.append(snake_copy)
+
+    start = time.time()
+    for snake in copies:
+        snake.evaluate(polar_transform)
+    elapsed = time.time() - start
+    results["time_per_snake_ms"] = 1000.0 * elapsed / max(1, len(copies))
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    if tracemalloc is not None and hasattr(tracemalloc, "reset_peak"):
+        for snake in copies:
+            snake.rank = None
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        peaks = []
+        for snake in copies:
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            snake.evaluate(polar_transform)
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        if not tracing:
+            tracemalloc.stop()
+
+        results["allocated_per_snake_kb"] = sum(peaks) / 1024.0 / max(1, len(peaks))
+        results["max_allocated_per_snake_kb"] = max(peaks) / 1024.0 if peaks else 0
+
+    return results
+
+
+def benchmark_segmentation_evaluate(segmentation, repeats=1):
+    """
+    Preprocess the frame of the segmentation, grow snakes from the first seeds and measure their evaluation.
+    @type segmentation: cellstar.segmentation.Segmentation
+    @rtype: dict
+    """
+    segmentation.pre_process()
+    segmentation.find_seeds(False)
+    segmentation.snakes_from_seeds()
+    segmentation.grow_snakes()
+    return benchmark_evaluate(segmentation.new_snakes, segmentation.polar_transform, repeats)
+
+
+def benchmark_background(image, parameters, repeats=1):
+    """
+    Measure background calculation with the exact and with the pyramid method
+    and the difference between their results.
+    @type image: np.ndarray
+    @type parameters: dict
+    @param repeats: number of calculations with every method
+    @return: measured values
+    @rtype: dict
+    """
+    from cellstar.core.image_repo import ImageRepo
+
+    results = {}
+    backgrounds = {}
+    for method in ["exact", "pyramid"]:
+        method_parameters = copy.deepcopy(parameters)
+        method_parameters["segmentation"]["processing"]["background"] = method
+        start = time.time()
+        for _ in range(repeats):
+            images = ImageRepo(image, method_parameters)
+            images.calculate_background()
+        results["%s_time_ms" % method] = 1000.0 * (time.time() - start) / max(1, repeats)
+        backgrounds[method] = images.background
+
+    difference = abs(backgrounds["exact"] - backgrounds["pyramid"])
+    results["max_difference"] = float(difference.max())
+    results["mean_difference"] = float(difference.mean())
+    return results
+
+
+def benchmark_median(image, sizes, levels=64, repeats=1):
+    """
+    Measure scipy median filter and histogram median filter for given window sizes
+    and the difference between their results.
+    @param image: image with values from 0 to 1, e.g. brighter_original of ImageRepo
+    @type image: np.ndarray
+    @param sizes: window sizes
+    @param levels: number of levels of the histogram median filter
+    @param repeats: number of filterings with every method
+    @return: measured values
+    @rtype: dict
+    """
+    from cellstar.utils.image_util import image_median_filter
+
+    results = {}
+    for size in sizes:
+        filtered = {}
+        for method, method_levels in [("scipy", None), ("histogram", levels)]:
+            start = time.time()
+            for _ in range(repeats):
+                filtered[method] = image_median_filter(image, size, method_levels)
+            results["%s_%d_time_ms" % (method, size)] = 1000.0 * (time.time() - start) / max(1, repeats)
+        results["max_difference_%d" % size] = float(abs(filtered["scipy"] - filtered["histogram"]).max())
+
+    return results
+
+
+def image_repo_bytes(images):
+    """
+    @type images: cellstar.core.image_repo.ImageRepo
+    @return: memory used by all arrays kept by the image repository (without the input image)
+    @rtype: int
+    """
+    arrays = [value for name, value in vars(images).items() if name not in ["image", "_image_original"]]
+    return images._blurred.nbytes + sum(array.nbytes for array in arrays if isinstance(array, np.ndarray))
+
+
+def benchmark_precision(image, parameters):
+    """
+    Segment image in double and single precision and compare the results. Cells are matched
+    when their intersection over union is greater than 0.5.
+    @type image: np.ndarray
+    @type parameters: dict
+    @return: measured values
+    @rtype: dict
+    """
+    from cellstar.core.polar_transform import PolarTransform
+    from cellstar.segmentation import Segmentation
+
+    results = {}
+    labels = {}
+    for precision in ["double", "single"]:
+        segmentation = Segmentation()
+        segmentation.parameters = copy.deepcopy(parameters)
+        segmentation.parameters["segmentation"]["processing"]["precision"] = precision
+        segmentation.polar_transform = PolarTransform.instance(parameters["segmentation"]["avgCellDiameter"],
+                                                               parameters["segmentation"]["stars"]["points"],
+                                                               parameters["segmentation"]["stars"]["step"],
+                                                               parameters["segmentation"]["stars"]["maxSize"])
+        segmentation.set_frame(image)
+        start = time.time()
+        labels[precision], _ = segmentation.run_segmentation()
+        results["%s_time_ms" % precision] = 1000.0 * (time.time() - start)
+        results["%s_repo_mb" % precision] = image_repo_bytes(segmentation.images) / 2.0 ** 20
+        results["%s_cells" % precision] = int(labels[precision].max())
+
+    double, single = labels["double"], labels["single"]
+    results["label_type"] = str(single.dtype)
+    results["foreground_difference"] = float(np.mean((double > 0) != (single > 0)))
+
+    # pixels shared by every pair of cells
+    pairs = np.bincount(double.ravel().astype(np.int64) * (single.max() + 1) + single.ravel(),
+                        minlength=(double.max() + 1) * (single.max() + 1)).reshape(double.max() + 1, -1)
+    areas_double = pairs.sum(axis=1)[:, np.newaxis]
+    areas_single = pairs.sum(axis=0)[np.newaxis, :]
+    iou = pairs / np.maximum(areas_double + areas_single - pairs, 1).astype(float)
+    matched = np.count_nonzero((iou[1:, 1:] > 0.5).any(axis=1))
+    results["matched_cells"] = float(matched) / max(1, double.max())
+    return results
+
+
+def benchmark_pre_process(image, parameters, workers=4, repeats=1):
+    """
+    Measure preprocessing of the image in the calling thread and in a pool of threads
+    and check that both give the same intermediate images.
+    @type image: np.ndarray
+    @type parameters: dict
+    @param workers: number of threads
+    @param repeats: number of preprocessings in every mode
+    @return: measured values
+    @rtype: dict
+    """
+    from cellstar.core.image_repo import ImageRepo
+
+    results = {}
+    repos = {}
+    for mode, mode_workers in [("serial", 1), ("threads", workers)]:
+        start = time.time()
+        for _ in range(repeats):
+            repos[mode] = ImageRepo(image, parameters)
+            repos[mode].pre_process(mode_workers)
+        results["%s_time_ms" % mode] = 1000.0 * (time.time() - start) / max(1, repeats)
+
+    results["identical"] = all(np.array_equal(getattr(repos["serial"], field), getattr(repos["threads"], field))
+                               for field in ImageRepo.used_after_pre_process)
+    return results
+
+
+def format_results(results):
+    return ", ".join("%s: %s" % (name, "%.2f" % value if isinstance(value, float) else value)
+                     for name, value in sorted(results.items()))
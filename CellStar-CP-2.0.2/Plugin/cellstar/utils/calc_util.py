@@ -6,6 +6,7 @@ Website: http://cellstar-algorithm.org/
 """
 
 import math
+import threading
 
 import numpy as np
 import scipy.ndimage as sp_image
@@ -93,6 +94,99 @@ def unstick_contour(edgepoints, unstick_coeff):
     return filtered
 
 
+def prefix_argmin(values):
+    """
+    Find position of the first minimum in every prefix along the last axis.
+    @type values: np.ndarray
+    @return: array such that result[..., k] == values[..., :k + 1].argmin()
+    @rtype: np.ndarray
+    """
+    running_min = np.minimum.accumulate(values, axis=-1)
+    new_min = np.empty(values.shape, dtype=bool)
+    new_min[..., 0] = True
+    np.less(values[..., 1:], running_min[..., :-1], out=new_min[..., 1:])
+    positions = np.where(new_min, np.arange(values.shape[-1]), 0)
+    return np.maximum.accumulate(positions, axis=-1)
+
+
+def smooth_contours(radius, max_diff, f_tot):
+    """
+    Smoothing contours of many snakes using greedy length cut. Rotating from min radius clockwise and anti
+    until no ray is cut. Snakes are processed in lock-step so that every step is a vectorized operation
+    on all not yet smoothed snakes, best allowed radius of the cut ray is read from prefix argmin table.
+    Every snake goes through exactly the same cuts as if it was smoothed alone.
+    @param radius: best radius for every ray (seeds x angles)
+    @type radius: np.ndarray
+    @param max_diff: max change of ray length per iter.
+    @type max_diff: np.ndarray
+    @param f_tot: quality function array (seeds x angles x radii)
+    @type f_tot: np.ndarray
+
+    @rtype (np.ndarray, np.ndarray)
+    @return (smoothed_radius, used_radius_bounds) both as (seeds x angles) arrays
+    """
+    seeds_number, points_number = radius.shape
+    max_radius_index = f_tot.shape[2] - 1
+    best_in_prefix = prefix_argmin(f_tot)
+
+    xmins2 = np.copy(radius)
+    xmaxs = np.copy(radius)
+
+    # state of the rotation of every snake
+    start = radius.argmin(axis=1)
+    step = np.ones(seeds_number, dtype=int)
+    iteration = np.zeros(seeds_number, dtype=int)
+    last_ok = np.zeros(seeds_number, dtype=bool)
+    any_cut = np.zeros(seeds_number, dtype=bool)
+    changed = np.zeros(seeds_number, dtype=bool)
+
+    active = np.arange(seeds_number)
+    while len(active) > 0:
+        # Finish rotations which went around the whole contour without a cut in the last ray.
+        finished = (iteration[active] >= points_number) & last_ok[active]
+        if finished.any():
+            ended = active[finished]
+            start[ended] = (start[ended] + iteration[ended] * step[ended]) % points_number
+            changed[ended] |= any_cut[ended]
+            anti = step[ended] < 0
+            stopped = anti & ~changed[ended]
+            changed[ended[anti]] = False
+            step[ended] = -step[ended]
+            iteration[ended] = 0
+            last_ok[ended] = False
+            any_cut[ended] = False
+
+            still_active = np.ones(len(active), dtype=bool)
+            still_active[np.flatnonzero(finished)[stopped]] = False
+            active = active[still_active]
+            if len(active) == 0:
+                break
+
+        active_step = step[active]
+        current = (start[active] + iteration[active] * active_step) % points_number
+        previous = (current - active_step) % points_number
+        previous_radius = xmins2[active, previous]
+        previous_max_diff = max_diff[previous_radius]
+        cut = xmins2[active, current] - previous_radius > previous_max_diff
+
+        if cut.any():
+            cut_seeds = active[cut]
+            cut_rays = current[cut]
+            cut_max_diff = previous_max_diff[cut]
+            bounds = previous_radius[cut] + cut_max_diff
+            xmaxs[cut_seeds, cut_rays] = bounds
+            new_radius = best_in_prefix[cut_seeds, cut_rays, np.minimum(bounds, max_radius_index)]
+            new_radius = np.where(active_step[cut] < 0,
+                                  np.maximum(new_radius, previous_radius[cut] - cut_max_diff), new_radius)
+            xmins2[cut_seeds, cut_rays] = new_radius
+            any_cut[cut_seeds] = True
+
+        last_ok[active] = ~cut
+        iteration[active] += 1
+
+    return xmins2, xmaxs
+
+
 def sub2ind(dim, xy):
     x,y = xy
     return x + y * dim
@@ -102,21 +196,17 @@ def get_gradient(im, index, border_thickness_steps):
     """
     Fun. calc. radial gradient including thickness of cell edges
     @param im: image (for which grad. will be calc.)
-    @param index: indices of pixes sorted by polar coordinates (alpha, radius)
+    @param index: indices of pixes sorted by polar coordinates (alpha, radius), optionally preceded by seed axis
     @param border_thickness_steps: number of steps to cop. grad. - depends on cell border thickness
     @return: gradient matrix for cell
     """
-    # index of axis used to find max grad.
-    max_gradient_along_axis = 2
-
     # preparing the image limits (called subimage) for which grad. will be computed
-    radius_lengths, angles = index.shape[:2]
+    radius_lengths = index.shape[-3]
 
     # matrix init
     # for each single step for each border thick. separated grad. is being computed
-    # at the end the max. grad values are returned (for all steps of thickness)
-    border_thickness_steps = int(border_thickness_steps)
-    gradients_for_steps = np.zeros((radius_lengths, angles, border_thickness_steps), dtype=np.float64)
+    # only the max. grad values are kept (for all steps of thickness)
+    gradients = np.full(index.shape[:-1], -np.inf, dtype=np.float64)
 
     # for every step of thickness:
     for border_thickness_step in range(1, int(border_thickness_steps) + 1):
@@ -125,8 +215,8 @@ def get_gradient(im, index, border_thickness_steps):
         matrix_start = border_thickness_step
 
         # find beg. and end indices of pix. for which the gradient will be computed
-        starting_index = index[:matrix_end, :]
-        ending_index = index[matrix_start:, :]
+        starting_index = index[..., :matrix_end, :, :]
+        ending_index = index[..., matrix_start:, :, :]
 
         # find internal in matrix where computed gradient will go
         intersect_start = int(math.ceil(border_thickness_step / 2.0))
@@ -136,10 +226,15 @@ def get_gradient(im, index, border_thickness_steps):
         current_step_gradient = im[Index.to_numpy(ending_index)] - im[Index.to_numpy(starting_index)]
         current_step_gradient /= np.sqrt(border_thickness_step)
 
-        # save gradient to previously determined place in results matrix
-        gradients_for_steps[intersect_start:intersect_end, :, border_thickness_step - 1] = current_step_gradient
+        # keep the max. of the current and previously computed gradients
+        current_slice = gradients[..., intersect_start:intersect_end, :]
+        np.maximum(current_slice, current_step_gradient, out=current_slice)
+
+    # the thickest step covers the narrowest interval, outside of it at least one step contributes zero
+    for outside_slice in [gradients[..., :intersect_start, :], gradients[..., intersect_end:, :]]:
+        np.maximum(outside_slice, 0, out=outside_slice)
 
-    return gradients_for_steps.max(axis=max_gradient_along_axis)
+    return gradients
 
 
 def extend_slices(my_slices, extension):
@@ -203,7 +298,7 @@ def mask_with_pil(ys, xs, yslice, xslice):
     return np.array(img) != 0
 
 
-def star_in_polygon(max_yx, polar_coordinate_boundary, seed_x, seed_y, polar_transform):
+def star_in_polygon(max_yx, polar_coordinate_boundary, seed_x, seed_y, polar_transform, out=None):
     max_y, max_x = max_yx
     polygon_x, polygon_y = polar_to_cartesian(polar_coordinate_boundary, seed_x, seed_y, polar_transform)
 
@@ -217,7 +312,11 @@ def star_in_polygon(max_yx, polar_coordinate_boundary, seed_x, seed_y, polar_tra
 
     small_boolean_mask = mask_with_pil(polygon_y_bounded, polygon_x_bounded, (y1, y2), (x1, x2))
 
-    boolean_mask = np.zeros((max_y, max_x), dtype=bool)
+    if out is None:
+        boolean_mask = np.zeros((max_y, max_x), dtype=bool)
+    else:
+        boolean_mask = out
+        boolean_mask.fill(False)
     boolean_mask[y1:y2, x1:x2] = small_boolean_mask
 
     yx = [y1, x1]
@@ -225,13 +324,55 @@ def star_in_polygon(max_yx, polar_coordinate_boundary, seed_x, seed_y, polar_tra
     return boolean_mask, small_boolean_mask, yx
 
 
-def multiply_list(ls, times):
-    list_length = len(ls)
-    integer_times = int(times)
-    fraction_elements = int((times - int(times)) * list_length)
-    res = ls * integer_times
-    res += ls[:fraction_elements]
-    return res
+def crop_to_content(mask):
+    """
+    Crop mask to the bounding box of its non zero values.
+    @type mask: np.ndarray
+    @return: cropped mask and position [y, x] of the cropped part
+    @rtype: (np.ndarray, list[int])
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    columns = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return mask[:0, :0], [0, 0]
+
+    y1, y2 = rows[0], rows[-1] + 1
+    x1, x2 = columns[0], columns[-1] + 1
+    return mask[y1:y2, x1:x2], [y1, x1]
+
+
+class ScratchBuffers(threading.local):
+    """
+    Arrays reused between calls instead of being allocated every time, separate for every thread.
+    Returned view is valid only until the buffer with the same name is requested again.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=bool):
+        """
+        @param name: name of the buffer
+        @param shape: shape of the requested view
+        @return: uninitialized view of the buffer
+        @rtype: np.ndarray
+        """
+        size = int(np.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.size < size or buffer.dtype != np.dtype(dtype):
+            buffer = np.empty(size, dtype=dtype)
+            self.buffers[name] = buffer
+        return buffer[:size].reshape(shape)
+
+
+def random_generator(seed=None):
+    """
+    Creates independent random generator, falls back to RandomState for NumPy without Generator.
+    @rtype: np.random.Generator | np.random.RandomState
+    """
+    if hasattr(np.random, "default_rng"):
+        return np.random.default_rng(seed)
+    return np.random.RandomState(seed)
 
 
 def to_int(num):
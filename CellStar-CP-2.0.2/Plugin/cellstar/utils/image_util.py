@@ -5,6 +5,10 @@ Date: 2013-2016
 Website: http://cellstar-algorithm.org/
 """
 
+import threading
+import weakref
+from collections import OrderedDict
+
 import numpy as np
 import scipy as sp
 import scipy.ndimage
@@ -22,8 +26,110 @@ except:
 
 from cellstar.utils.calc_util import extend_slices, fast_power, to_int
 
+# Fill holes stops after this number of iterations even if it has not reached the fix point.
+FILL_HOLES_MAX_ITERATIONS = 10
+
+
+class ArrayCache(object):
+    """
+    Least recently used cache of arrays, e.g. rfft2 spectra used by fft_convolve or blurred images.
+    Arrays calculated from a source array can be keyed by its identity, then they are dropped when the source
+    is freed, so it must not be modified in place afterwards.
+    The oldest arrays are dropped when all of them use more than max_bytes of memory.
+    """
 
-def fft_convolve(in1, in2, times):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._arrays = OrderedDict()  # key -> (source reference or None, array)
+        self._bytes = 0
+        self._statistics = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def get(self, key, calculate, source=None):
+        """
+        @param key: hashable key of the array
+        @param calculate: function calculating the array when it is not in the cache
+        @param source: array from which the array is calculated if it is to be keyed by its identity
+        @rtype: np.ndarray
+        """
+        if source is not None:
+            key = (id(source),) + key
+
+        with self._lock:
+            entry = self._arrays.get(key)
+            if entry is not None and (entry[0] is None or entry[0]() is source):
+                self._arrays[key] = self._arrays.pop(key)
+                self._statistics["hits"] += 1
+                return entry[1]
+            self._statistics["misses"] += 1
+
+        array = calculate()
+        if array.nbytes > self.max_bytes:
+            return array
+
+        reference = None
+        if source is not None:
+            reference = weakref.ref(source, lambda _, k=key: self._remove(k))
+
+        with self._lock:
+            self._remove(key)
+            self._arrays[key] = (reference, array)
+            self._bytes += array.nbytes
+            self._evict()
+
+        return array
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes:
+            _, (_, evicted) = self._arrays.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self._statistics["evictions"] += 1
+
+    def _remove(self, key):
+        with self._lock:
+            entry = self._arrays.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1].nbytes
+
+    def statistics(self):
+        """
+        @return: number of hits, misses and evictions and the number and memory of kept arrays
+        @rtype: dict
+        """
+        with self._lock:
+            statistics = dict(self._statistics)
+            statistics["arrays"] = len(self._arrays)
+            statistics["bytes"] = self._bytes
+        return statistics
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+            self._bytes = 0
+
+
+# spectra of images are keyed by identity of the source array (and how the convolved image is derived from it)
+# and kept only if the caller asks to (see keep_spectrum of image_blur and image_smooth),
+# spectra of kernels by their kind and size, both also by the padded FFT shape
+spectrum_cache = ArrayCache(256 * 2 ** 20)
+
+
+def fft_convolve(in1, in2, times, in1_source=None, in2_key=None):
+    """
+    Convolves in1 with in2 repeated times.
+    @param in1_source: (array, derivation) if in1 is derived from the array only by the hashable derivation,
+    then spectrum of in1 is kept in spectrum_cache for the lifetime of the array
+    @param in2_key: hashable description of in2, if given spectrum of in2 to the power of times is kept in spectrum_cache
+    """
     def _centered(arr, newsize):
         # Return the center newsize portion of the array.
         currsize = np.array(arr.shape)
@@ -44,8 +150,22 @@ def fft_convolve(in1, in2, times):
     fshape = [next_fast_len(int(d)) for d in shape]
     fslice = tuple([slice(0, int(sz)) for sz in shape])
 
-    resfft = fast_power(rfft2(in2, fshape), times)
-    resfft = resfft * rfft2(in1, fshape)
+    def kernel_spectrum():
+        return fast_power(rfft2(in2, fshape), times)
+
+    def image_spectrum():
+        return rfft2(in1, fshape)
+
+    if in2_key is None:
+        resfft = kernel_spectrum()
+    else:
+        resfft = spectrum_cache.get(in2_key + (times, tuple(fshape)), kernel_spectrum)
+
+    if in1_source is None:
+        resfft = resfft * image_spectrum()
+    else:
+        source, derivation = in1_source
+        resfft = resfft * spectrum_cache.get((derivation, tuple(fshape)), image_spectrum, source)
     ret = irfft2(resfft, fshape)[fslice].copy()
     ret = ret.real
 
@@ -73,6 +193,17 @@ def get_circle_kernel(radius):
     return x ** 2 + y ** 2 <= radius ** 2
 
 
+def within_distance(image, radius):
+    """
+    Marks pixels not farther than radius from foreground pixels, which is binary dilation with
+    get_circle_kernel(radius) calculated from Euclidean distance transform in time independent of radius.
+    """
+    if not image.any():
+        return np.zeros(image.shape, dtype=bool)
+    squared_distances = np.rint(sp.ndimage.distance_transform_edt(np.logical_not(image)) ** 2)
+    return squared_distances <= radius ** 2
+
+
 def image_dilate(image, radius):
     image = np.copy(image)
     if radius <= 1:
@@ -85,9 +216,7 @@ def image_dilate(image, radius):
     lp, hp = contain_pixel(image.shape, (ys[0] - radius, xs[0] - radius)), \
              contain_pixel(image.shape, (ys[1] + radius, xs[1] + radius))
     ys, xs = (lp[0], hp[0]), (lp[1], hp[1])
-    morphology_element = get_circle_kernel(radius)
-    dilated_part = sp.ndimage.morphology.binary_dilation(image[ys[0]:ys[1], xs[0]:xs[1]], morphology_element)
-    image[ys[0]:ys[1], xs[0]:xs[1]] = dilated_part
+    image[ys[0]:ys[1], xs[0]:xs[1]] = within_distance(image[ys[0]:ys[1], xs[0]:xs[1]], radius)
     return image
 
 
@@ -96,8 +225,13 @@ def image_dilate_with_element(image, n):
 
 
 def image_erode(image, radius):
-    morphology_element = get_circle_kernel(radius)
-    return sp.ndimage.morphology.binary_erosion(image, morphology_element)
+    """
+    Binary erosion with get_circle_kernel(radius) (pixels outside of the image are background)
+    calculated from Euclidean distance transform in time independent of radius.
+    """
+    padded = np.pad(image.astype(bool), 1, mode='constant')
+    squared_distances = np.rint(sp.ndimage.distance_transform_edt(padded)[1:-1, 1:-1] ** 2)
+    return squared_distances > radius ** 2
 
 
 def fill_foreground_holes(mask, kernel_size, minimal_hole_size, min_cluster_area_scaled, mask_min_radius_scaled):
@@ -115,37 +249,39 @@ def fill_foreground_holes(mask, kernel_size, minimal_hole_size, min_cluster_area
 
 
 def mark_small_areas(mask, max_hole_size, result_mask):
+    """
+    Marks in result_mask (in place) components of mask with area smaller than max_hole_size.
+    """
     components, num_components = sp.ndimage.label(mask, np.ones((3, 3)))
-    slices = sp.ndimage.find_objects(components)
-    for label, slice in zip(range(1, num_components + 1), slices):
-        components_slice = components[slice] == label
-        if np.count_nonzero(components_slice) < max_hole_size:
-            result_mask[slice][components_slice] = True
+    small_components = np.bincount(components.ravel()) < max_hole_size
+    small_components[0] = False
+    result_mask |= small_components[components]
     return result_mask
 
 
 def dilate_big_areas(mask, min_area_size, dilate_radius):
+    """
+    Adds to mask dilation of its components with area greater than min_area_size.
+    Dilation of the union of components is the union of their dilations.
+    """
     components, num_components = sp.ndimage.label(mask, np.ones((3, 3)))
-    component = np.zeros(mask.shape, dtype=bool)
-    for label in range(1, num_components + 1):
-        np.equal(components, label, component)
-        if np.count_nonzero(component) > min_area_size:
-            tmp_mask = image_dilate(component, dilate_radius)
-            mask = mask | tmp_mask
+    big_components = np.bincount(components.ravel()) > min_area_size
+    big_components[0] = False
+    if not big_components.any():
+        return mask
 
-    return mask
+    return mask | image_dilate(big_components[components], dilate_radius)
 
 
-def fill_holes(mask, kernel_size, minimal_hole_size):
+def fill_holes(mask, kernel_size, minimal_hole_size, max_iterations=FILL_HOLES_MAX_ITERATIONS):
     """
     Fills holes in a given mask using iterative close + dilate morphological operations and filtering small patches.
     @param mask: mask which holes are to be filled
     @param kernel_size: size of the morphological element used to dilate/erode mask
     @param minimal_hole_size: holes with area smaller than param are to be removed
+    @param max_iterations: maximal number of iterations if the fix point is not reached earlier
     """
-    nr = 1
-    morphology_element = get_circle_kernel(kernel_size)
-    while True:
+    for _ in range(max_iterations):
         new_mask = mask.copy()
         # find connected components
         components, num_components = sp.ndimage.label(np.logical_not(new_mask), np.ones((3, 3)))
@@ -159,10 +295,10 @@ def fill_holes(mask, kernel_size, minimal_hole_size):
             else:
                 # shrink components and check if they fell apart
                 # close holes
-                components_slice = sp.ndimage.morphology.binary_closing(components_slice, morphology_element)
+                components_slice = image_erode(within_distance(components_slice, kernel_size), kernel_size)
 
                 # erode holes
-                components_slice = sp.ndimage.morphology.binary_erosion(components_slice, morphology_element)
+                components_slice = image_erode(components_slice, kernel_size)
 
                 # don't invade masked pixels
                 components_slice &= np.logical_not(new_mask[slice])
@@ -176,8 +312,6 @@ def fill_holes(mask, kernel_size, minimal_hole_size):
         else:
             mask = new_mask
 
-        nr += 1
-
     return mask
 
 
@@ -229,24 +363,62 @@ def exclude_segments(image, segments, val):
     return image_segments_valued
 
 
-def image_median_filter(image, size):
+def image_median_filter(image, size, levels=None):
+    """
+    Median filter with square window.
+    @param levels: if given, median of the 0-1 image is calculated from histograms with this number of levels
+    in time independent of window size (see image_histogram_median_filter)
+    """
     if size < 1:
         return image
     
     size = to_int(size)
+    if levels is not None:
+        return image_histogram_median_filter(image, size, levels)
     return median_filter(image, (size, size))
 
 
-def image_blur(image, times):
+def image_histogram_median_filter(image, size, levels):
+    """
+    Median filter which quantizes 0-1 image to given number of levels and for every level counts pixels
+    not greater than it in every window using running sums. Zero stays the only value in the lowest level
+    so the result is zero exactly where the median is zero, otherwise it is rounded up to the next level
+    (error is less than 1 / (levels - 1)). Windows and borders are the same as in median_filter.
+    @param image: image with values from 0 to 1
+    @param size: size of the square window
+    @param levels: number of quantization levels
+    """
+    size = to_int(size)
+    quantized = np.ceil(np.clip(image, 0, 1) * (levels - 1)).astype(np.min_scalar_type(levels))
+    before = size // 2 + 1
+    padded = np.pad(quantized, ((before, size - before), (before, size - before)), mode='symmetric')
+
+    # Window counts are taken as differences of cumulative sums which are exact in modular arithmetic
+    # as long as the counts themselves fit in the type.
+    count_type = np.int16 if size * size <= np.iinfo(np.int16).max else np.int32
+    rank = (size * size) // 2 + 1
+    median_level = np.zeros(image.shape, dtype=count_type)
+    for level in range(levels - 1):
+        cumulative = np.cumsum(padded <= level, axis=0, dtype=count_type)
+        cumulative = np.cumsum(cumulative[size:] - cumulative[:-size], axis=1, dtype=count_type)
+        median_level += (cumulative[:, size:] - cumulative[:, :-size]) < rank
+
+    return median_level / float(levels - 1)
+
+
+def image_blur(image, times, keep_spectrum=False):
     """
     Performs image blur with kernel: [[2, 3, 2], [3, 12, 3], [2, 3, 2]] / 32
     @param image: image to be blurred (assumed as numpy.array of values from 0 to 1)
     @param times: specifies how many times blurring will be performed
+    @param keep_spectrum: keep spectrum of the image in spectrum_cache while the image lives,
+    only for images which are not modified in place
     """
     kernel = np.array([[2, 3, 2], [3, 12, 3], [2, 3, 2]]) / 32.0
 
     if times >= 8:
-        return fft_convolve(image, kernel, times)
+        in1_source = (image, None) if keep_spectrum else None
+        return fft_convolve(image, kernel, times, in1_source=in1_source, in2_key=("blur",))
     else:
         blurred = convolve(image, kernel)
         for _ in range(int(times) - 1):
@@ -254,35 +426,80 @@ def image_blur(image, times):
         return blurred
 
 
-def image_smooth(image, radius, fft_use=True):
+def image_smooth(image, radius, fft_use=True, keep_spectrum=False):
     """
     Performs image blur with circular kernel.
     @param image: image to be blurred (assumed as numpy.array of values from 0 to 1)
     @param radius: radius of the kernel
+    @param keep_spectrum: keep spectrum of the image in spectrum_cache while the image lives,
+    only for images which are not modified in place
     """
     if radius < 1:
         return image
 
     kernel = get_circle_kernel(radius).astype(float)
     kernel /= np.sum(kernel)
+    source = image
     image = np.array(image, dtype=float)
 
     if radius >= 8 and fft_use:
         image_2 = np.pad(image, int(radius), mode='reflect')
-        res = fft_convolve(image_2, kernel, 1)
+        in1_source = (source, ("reflect", int(radius))) if keep_spectrum else None
+        res = fft_convolve(image_2, kernel, 1, in1_source=in1_source, in2_key=("circle", radius))
         radius_round = to_int(radius)
         return res[radius_round:-radius_round, radius_round:-radius_round]
     else:
         return convolve(image, kernel, mode='reflect', cval=0.0)
 
 
-def image_normalize(image):
+def image_downsample(image, factor):
+    """
+    Averages image in factor x factor blocks. Image is extended at the bottom and right with its edge values.
+    @param image: image to be downsampled
+    @param factor: integer downsampling factor
+    """
+    image = np.asarray(image, dtype=float)
+    if factor == 1:
+        return image.copy()
+
+    height, width = image.shape
+    padded = np.pad(image, ((0, -height % factor), (0, -width % factor)), mode='edge')
+    return padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor).mean(axis=(1, 3))
+
+
+def image_upsample(image, factor, shape):
+    """
+    Bilinear interpolation of the image produced by image_downsample back to the original shape.
+    @param image: block averaged image
+    @param factor: integer downsampling factor
+    @param shape: shape of the original image
+    """
+    upsampled = np.asarray(image, dtype=float)
+    for axis, size in enumerate(shape):
+        # Centre of every block is in the middle of its factor pixels.
+        coordinates = np.clip((np.arange(size) + 0.5) / factor - 0.5, 0, upsampled.shape[axis] - 1)
+        low = np.floor(coordinates).astype(int)
+        high = np.minimum(low + 1, upsampled.shape[axis] - 1)
+        fraction = coordinates - low
+        fraction_shape = [1, 1]
+        fraction_shape[axis] = size
+        fraction = fraction.reshape(fraction_shape)
+        upsampled = np.take(upsampled, low, axis) * (1 - fraction) + np.take(upsampled, high, axis) * fraction
+
+    return upsampled
+
+
+def image_normalize(image, minimum=None, maximum=None):
     """
     Performs image normalization (vide: matlab mat2gray)
     @param image: image to be normalized (assumed as numpy.array of values from 0 to 1)
+    @param minimum: value mapped to 0, minimum of the image if not given
+    @param maximum: value mapped to 1, maximum of the image if not given
     """
-    minimum = np.amin(image)
-    maximum = np.amax(image)
+    if minimum is None:
+        minimum = np.amin(image)
+    if maximum is None:
+        maximum = np.amax(image)
 
     delta = 1
     if maximum != minimum:
@@ -15,9 +15,7 @@ class Index(object):
 
     @staticmethod
     def to_numpy(index):
-        if len(index.shape) == 2:
-            return index[:, 0], index[:, 1]
-        elif len(index.shape) == 3:
-            return index[:, :, 0], index[:, :, 1]
+        if len(index.shape) >= 2:
+            return index[..., 0], index[..., 1]
         else:
             return index